@@ -0,0 +1,240 @@
+"""fake_ncei module serves a local stand-in of the NCEI search and data APIs
+
+The station catalog and the daily values are synthetic but shaped like the
+real answers of /access/services/search/v1/data and /access/services/data/v1,
+and every value only depends on the station and the day so repeated or
+chunked requests always agree.  Latency and error rates are configurable.
+"""
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+SEARCH_PATH = "/access/services/search/v1/data"
+DATA_PATH = "/access/services/data/v1"
+
+# stations per search page without a limit parameter, and the largest limit
+SEARCH_LIMIT = 25
+MAX_SEARCH_LIMIT = 1000
+
+# synthetic stations are spread over this region (south, west, north, east)
+REGION = (40.0, -100.0, 45.0, -90.0)
+
+MAIN_TYPES = ("TMIN", "TMAX", "PRCP")
+EXTRA_TYPES = ("SNOW", "SNWD", "TAVG", "AWND", "TOBS")
+
+
+class Catalog:
+    """synthetic GHCND stations"""
+
+    def __init__(self, station_count, seed=0, first_year=1950, last_year=2023):
+        generator = random.Random(seed)
+        south, west, north, east = REGION
+        self.last_date = datetime.date(last_year, 12, 31)
+
+        self.stations = {}
+        for number in range(station_count):
+            data_types = [data_type for data_type in MAIN_TYPES if generator.random() < 0.85]
+            data_types += [data_type for data_type in EXTRA_TYPES if generator.random() < 0.5]
+            start_year = generator.randint(first_year, last_year - 1)
+            self.stations["USC%08d" % number] = {
+                "latitude": round(generator.uniform(south, north), 4),
+                "longitude": round(generator.uniform(west, east), 4),
+                "elevation": round(generator.uniform(150, 600), 1),
+                "dataTypes": data_types,
+                "start": datetime.date(start_year, generator.randint(1, 12), 1),
+            }
+
+    def search(self, bbox, startdate, enddate):
+        """search v1 results of the stations inside bbox with data in the date range"""
+        north, west, south, east = [float(value) for value in bbox.split(",")]
+        start = datetime.date.fromisoformat(startdate[:10])
+        end = datetime.date.fromisoformat(enddate[:10])
+
+        results = []
+        for station_id, station in self.stations.items():
+            if not (south <= station["latitude"] <= north and west <= station["longitude"] <= east):
+                continue
+            if station["start"] > end or self.last_date < start:
+                continue
+            date_range = {"start": station["start"].isoformat() + "T00:00:00",
+                          "end": self.last_date.isoformat() + "T23:59:59"}
+            results.append({
+                "location": {"type": "Point",
+                             "coordinates": [station["longitude"], station["latitude"]]},
+                "stations": [{"id": station_id, "name": "STATION " + station_id,
+                              "dataTypes": [{"id": data_type, "dateRange": date_range}
+                                            for data_type in station["dataTypes"]]}],
+            })
+
+        return results
+
+    def records(self, station_ids, startdate, enddate, data_types=None,
+                location=False, attributes=True):
+        """data v1 records of the stations, one per station and day"""
+        start = datetime.date.fromisoformat(startdate[:10])
+        end = datetime.date.fromisoformat(enddate[:10])
+
+        for station_id in station_ids:
+            station = self.stations.get(station_id)
+            if station is None:
+                continue
+            day = max(start, station["start"])
+            while day <= end:
+                generator = random.Random(station_id + day.isoformat())
+                if generator.random() < 0.97:  # some days are missing
+                    yield self.record(station_id, station, day, generator, data_types,
+                                      location, attributes)
+                day += datetime.timedelta(days=1)
+
+    def record(self, station_id, station, day, generator, data_types, location, attributes):
+        """one day of one station"""
+        record = {"DATE": day.isoformat(), "STATION": station_id}
+        if location:
+            record.update({"LATITUDE": str(station["latitude"]),
+                           "LONGITUDE": str(station["longitude"]),
+                           "ELEVATION": str(station["elevation"]),
+                           "NAME": "STATION " + station_id})
+
+        season = -150 * (1 + (day.timetuple().tm_yday - 200) ** 2 / -20000)
+        for data_type in station["dataTypes"]:
+            if data_types is not None and data_type not in data_types:
+                continue
+            if generator.random() < 0.05:  # some values are missing
+                continue
+            if data_type in ("TMIN", "TMAX", "TAVG", "TOBS"):
+                value = int(season + generator.gauss(0, 40)) + (80 if data_type == "TMAX" else 0)
+            else:
+                value = max(0, int(generator.expovariate(0.05)) - 20)
+            record[data_type] = "%6d" % value
+            if attributes:
+                record[data_type + "_ATTRIBUTES"] = ",,7,0700"
+
+        return record
+
+
+class Handler(BaseHTTPRequestHandler):
+    """answers the two NCEI endpoints"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.count("bytes", len(payload))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parameters = {key: values[0] for key, values in parse_qs(url.query).items()}
+        server = self.server
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path not in (SEARCH_PATH, DATA_PATH):
+            self.send_json({"errorMessage": "not found"}, 404)
+            return
+
+        if server.error_rate and server.random() < server.error_rate:
+            server.count("errors")
+            self.send_json({"errorCode": 503, "errorMessage": "Service Unavailable", "errors": []},
+                           503, {"Retry-After": "0"})
+            return
+
+        if url.path == SEARCH_PATH:
+            server.count("search_requests")
+            results = server.catalog.search(parameters["bbox"], parameters["startDate"],
+                                            parameters["endDate"])
+            # one page of the results, count is the number of all of them
+            limit = min(int(parameters.get("limit", SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+            offset = int(parameters.get("offset", 0))
+            page = results[offset:offset + limit]
+            if len(page) == 0:
+                self.send_json({"count": len(results)})
+            else:
+                self.send_json({"count": len(results), "results": page})
+            return
+
+        server.count("data_requests")
+        data_types = parameters.get("dataTypes")
+        records = list(server.catalog.records(
+            parameters["stations"].split(","), parameters["startDate"], parameters["endDate"],
+            data_types.split(",") if data_types else None,
+            location=parameters.get("includeStationLocation") in ("1", "true"),
+            attributes=parameters.get("includeAttributes") not in ("0", "false")))
+        server.count("records", len(records))
+        self.send_json(records)
+
+
+class FakeNCEIServer(ThreadingHTTPServer):
+    """threaded http server holding the catalog and the request counters"""
+
+    daemon_threads = True
+
+    def __init__(self, catalog, port=0, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.generator = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%i" % self.server_address[1]
+
+    def random(self):
+        with self.lock:
+            return self.generator.random()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset_counters(self):
+        with self.lock:
+            counters = self.counters
+            self.counters = {}
+        return counters
+
+
+def start_server(station_count, port=0, latency=0.0, error_rate=0.0, seed=0):
+    """start the stand-in server on a background thread"""
+    server = FakeNCEIServer(Catalog(station_count, seed), port, latency, error_rate, seed)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a local stand-in of the NCEI APIs.')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('-n', '--stations', type=int, default=1000)
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='seconds added to every answer')
+    parser.add_argument('-e', '--errorrate', type=float, default=0.0,
+                        help='share of the requests answered with 503')
+    args = parser.parse_args()
+
+    fake = start_server(args.stations, args.port, args.latency, args.errorrate)
+    print("serving on " + fake.base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.shutdown()
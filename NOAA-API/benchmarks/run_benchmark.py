@@ -0,0 +1,246 @@
+"""run_benchmark module times the full read_csv_file pipeline against fake_ncei
+
+Every scale runs in its own process inside a temporary folder, so the peak
+memory of one scale does not leak into the next one.  The NCEI urls of
+search_api are pointed at a local fake_ncei server; nothing reaches the
+real API.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import fake_ncei
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# input points, stations in the synthetic catalog and years downloaded
+SCALES = {
+    "small": {"points": 5, "stations": 400, "years": 2},
+    "medium": {"points": 25, "stations": 2000, "years": 5},
+    "large": {"points": 100, "stations": 8000, "years": 20},
+}
+
+# smaller differences against the baseline are noise, in seconds or MB
+MIN_DIFFERENCE = 0.05
+
+# stages recorded by the metrics module of the pipeline, with processes the
+# partition stages are summed over the processes
+STAGES = ["search", "download", "station_report", "json_to_csv", "data_coverage",
+          "write_outputs"]
+
+
+def write_input(path, points, seed=0):
+    """write an input csv of random points inside the fake region"""
+    generator = random.Random(seed)
+    south, west, north, east = fake_ncei.REGION
+    with open(path, "w") as fout:
+        fout.write("station_name,Latitude,Longitude\n")
+        for number in range(points):
+            fout.write("point_%i,%.5f,%.5f\n" % (number, generator.uniform(south, north),
+                                                 generator.uniform(west, east)))
+
+
+def peak_memory_mb():
+    """peak resident memory of this process or of its largest child process in MB"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # linux reports kB, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_scale(base_url, workdir, options, results):
+    """run the pipeline once on the files of workdir, in a child process"""
+    import logging
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=options["log_level"])
+
+    sys.path.insert(0, PIPELINE_DIR)
+    import read_csv_file
+    import search_api
+    import metrics
+
+    search_api.SEARCH_URL = base_url + fake_ncei.SEARCH_PATH
+    search_api.DATA_URL = base_url + fake_ncei.DATA_PATH
+
+    started = time.perf_counter()
+    read_csv_file.main(input_file=os.path.join(workdir, "input.csv"),
+                       start_date=options["start_date"], end_date=options["end_date"],
+                       workers=options["workers"], rate=options["rate"],
+                       cache_path=os.path.join(workdir, "search_cache.sqlite"),
+                       storage=options["storage"], stream=options["stream"],
+                       profile_dir=options["profile_dir"], processes=options["processes"],
+                       partition_size=options["partition_size"],
+                       in_memory=options["in_memory"],
+                       output_root=os.path.join(workdir, "output"),
+                       report_workers=options["report_workers"],
+                       asynchronous=options["asynchronous"],
+                       all_data_types=options["all_data_types"])
+    total = time.perf_counter() - started
+
+    summary = metrics.get_metrics().summary()
+    results.put({"total": total,
+                 "stages": {name: timing["wall_seconds"]
+                            for name, timing in summary["stages"].items()},
+                 "cpu": {name: timing["cpu_seconds"]
+                         for name, timing in summary["stages"].items()},
+                 "peak_memory_mb": peak_memory_mb()})
+
+
+def benchmark(scale, args):
+    """run one scale against a fresh fake server and return its measures"""
+    size = SCALES[scale]
+    server = fake_ncei.start_server(size["stations"], latency=args.latency,
+                                    error_rate=args.errorrate, seed=args.seed)
+    end_year = 2023
+    options = {"start_date": "%i-01-01" % (end_year - size["years"] + 1),
+               "end_date": "%i-12-31" % end_year,
+               "workers": args.workers, "rate": args.rate, "storage": args.storage,
+               "stream": args.stream, "profile_dir": args.profiledir,
+               "processes": args.processes, "partition_size": args.partitionsize,
+               "in_memory": args.inmemory, "report_workers": args.reportworkers,
+               "asynchronous": args.asynchronous, "all_data_types": args.alldatatypes,
+               "log_level": "INFO" if args.verbose else "ERROR"}
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    try:
+        with tempfile.TemporaryDirectory(prefix="noaa-bench-") as workdir:
+            write_input(os.path.join(workdir, "input.csv"), size["points"], args.seed)
+            process = context.Process(target=run_scale,
+                                      args=(server.base_url, workdir, options, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("%s benchmark failed with exit code %i"
+                                   % (scale, process.exitcode))
+            measures = results.get()
+    finally:
+        counters = server.reset_counters()
+        server.shutdown()
+        server.server_close()
+
+    total = measures["total"]
+    measures.update({
+        "scale": scale,
+        "points": size["points"],
+        "stations": size["stations"],
+        "years": size["years"],
+        "search_requests": counters.get("search_requests", 0),
+        "data_requests": counters.get("data_requests", 0),
+        "errors": counters.get("errors", 0),
+        "records": counters.get("records", 0),
+        "megabytes": counters.get("bytes", 0) / 1e6,
+        "points_per_s": size["points"] / total,
+        "records_per_s": counters.get("records", 0) / total,
+    })
+    return measures
+
+
+def print_table(all_measures):
+    """print one row per scale"""
+    header = ["scale", "points", "records", "MB", "requests", "errors"] + STAGES + \
+        ["total_s", "points/s", "records/s", "peak_MB"]
+    rows = []
+    for measures in all_measures:
+        rows.append([measures["scale"], str(measures["points"]), str(measures["records"]),
+                     "%.1f" % measures["megabytes"],
+                     str(measures["search_requests"] + measures["data_requests"]),
+                     str(measures["errors"])] +
+                    ["%.2f" % measures["stages"].get(stage, 0.0) for stage in STAGES] +
+                    ["%.2f" % measures["total"], "%.2f" % measures["points_per_s"],
+                     "%.0f" % measures["records_per_s"], "%.0f" % measures["peak_memory_mb"]])
+
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def compare(all_measures, baseline_path, tolerance):
+    """list the measures more than tolerance worse than the baseline file"""
+    with open(baseline_path) as fin:
+        baseline = {measures["scale"]: measures for measures in json.load(fin)}
+
+    regressions = []
+    for measures in all_measures:
+        previous = baseline.get(measures["scale"])
+        if previous is None:
+            continue
+        pairs = [("total", previous["total"], measures["total"]),
+                 ("peak_memory_mb", previous["peak_memory_mb"], measures["peak_memory_mb"])]
+        pairs += [(stage, previous["stages"].get(stage, 0.0), value)
+                  for stage, value in measures["stages"].items()]
+        for name, before, after in pairs:
+            if after > before * (1 + tolerance) and after - before > MIN_DIFFERENCE:
+                regressions.append("%s %s: %.2f -> %.2f" % (measures["scale"], name,
+                                                            before, after))
+
+    return regressions
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the NOAA pipeline against a local stand-in NCEI server.')
+    parser.add_argument('-s', '--scales', nargs='+', choices=list(SCALES),
+                        default=["small", "medium"], help='scales to run')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='seconds added by the server to every answer')
+    parser.add_argument('-e', '--errorrate', type=float, default=0.0,
+                        help='share of the requests answered with 503')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='stations downloaded at the same time')
+    parser.add_argument('-r', '--rate', type=float, default=1000.0,
+                        help='maximum number of requests per second')
+    parser.add_argument('-g', '--storage', choices=["csv", "npz"], default="csv")
+    parser.add_argument('-st', '--stream', action='store_true',
+                        help='stream the downloads to disk')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='processes searching and reporting partitions of the input')
+    parser.add_argument('-ps', '--partitionsize', type=int, default=1000,
+                        help='input points per partition with processes')
+    parser.add_argument('-im', '--inmemory', action='store_true',
+                        help='hand the tables between the report stages in memory')
+    parser.add_argument('-rw', '--reportworkers', type=int, default=4,
+                        help='threads converting and covering the stations')
+    parser.add_argument('-as', '--asynchronous', action='store_true',
+                        help='download on one asyncio event loop, needs aiohttp')
+    parser.add_argument('-ad', '--alldatatypes', action='store_true',
+                        help='download every data type, attribute and station location')
+    parser.add_argument('-pf', '--profiledir',
+                        help='write a cProfile file of every stage to this folder')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--json', help='write the measures to this JSON file')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON file of an earlier run to compare against')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='allowed slow down against the baseline (0.2 = 20%%)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the pipeline logs')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    all_measures = [benchmark(scale, args) for scale in args.scales]
+    print_table(all_measures)
+
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump(all_measures, fout, indent=2)
+
+    if args.baseline:
+        regressions = compare(all_measures, args.baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
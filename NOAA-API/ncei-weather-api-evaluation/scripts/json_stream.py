@@ -0,0 +1,101 @@
+"""json_stream module reads and writes large JSON arrays a few records at a time"""
+import codecs
+import json
+
+CHUNK_BYTES = 64 * 1024
+CHUNK_RECORDS = 10000
+
+
+def iter_json_array(chunks):
+    """yield the records of a JSON array from an iterable of byte or str chunks
+
+    raises ValueError when the text is not a JSON array, with the decoded
+    object as second argument when it is a JSON object (an API error)
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+
+    while not finished:
+        chunk = next(chunks, None)
+        if chunk is None:
+            buffer += utf8.decode(b"", final=True)
+            finished = True
+        else:
+            buffer += utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+        while True:
+            # skip the separators between records
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+
+            if not started:
+                if buffer[position] == "[":
+                    started = True
+                    position += 1
+                    continue
+                if finished:
+                    error = json.loads(buffer[position:]) if buffer[position] == "{" else None
+                    raise ValueError("response is not a JSON array", error)
+                break
+
+            if buffer[position] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                break  # record is not complete yet, read more
+            if not finished and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+                break  # a number can go on in the next chunk, read more
+            position = end
+            yield record
+
+        # drop what was already decoded
+        buffer = buffer[position:]
+        position = 0
+
+    raise ValueError("JSON array is not terminated" if started else "response is empty")
+
+
+def iter_json_file(path, chunk_bytes=CHUNK_BYTES):
+    """yield the records of a JSON array file"""
+    with open(path, "rb") as fin:
+        yield from iter_json_array(iter(lambda: fin.read(chunk_bytes), b""))
+
+
+def batched(records, size=CHUNK_RECORDS):
+    """group records into lists of at most size records"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_json_array(records, path, chunk_records=CHUNK_RECORDS):
+    """write records as a JSON array, chunk_records at a time
+
+    returns the number of records written
+    """
+    count = 0
+    with open(path, "w") as fout:
+        fout.write("[")
+        for batch in batched(records, chunk_records):
+            fout.write(("," if count else "") +
+                       ",".join("\n" + json.dumps(record) for record in batch))
+            count += len(batch)
+        fout.write("\n]\n")
+
+    return count
@@ -0,0 +1,265 @@
+"""metrics module records where a run spends its time
+
+One registry per process keeps counters (requests, bytes, records, cache
+hits), latency histograms and the wall and CPU time of every pipeline stage.
+It is written as a JSON summary and, when asked, in the Prometheus text
+format.  Stages can be profiled with cProfile, switched on and off at any
+time with set_profiling or the NOAA_PROFILE_DIR environment variable.
+"""
+import cProfile
+import contextlib
+import copy
+import json
+import os
+import threading
+import time
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+PROMETHEUS_PREFIX = "noaa_"
+
+# folder of the profiles when no folder is given
+PROFILE_ENV = "NOAA_PROFILE_DIR"
+
+
+def default_profile_dir(directory=None):
+    """directory, or the NOAA_PROFILE_DIR folder when it is None"""
+    if directory is not None:
+        return directory
+    return os.environ.get(PROFILE_ENV) or None
+
+
+def label_key(labels):
+    """hashable and ordered form of a label dict"""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def prometheus_labels(key, extra=()):
+    """{name="value",...} of a label key, empty without labels"""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, value.replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+class Metrics:
+    """counters, histograms and stage timings of one process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name -> label key -> value
+        self.histograms = {}  # name -> label key -> [bucket counts, sum, count]
+        self.buckets = {}  # histogram name -> bucket bounds
+        self.stages = {}  # stage name -> wall, cpu and calls
+        self.profile_dir = None
+        self.set_profiling(default_profile_dir())
+        self.profiling = False  # a stage is being profiled
+
+    def count(self, name, amount=1, **labels):
+        """add amount to a counter"""
+        key = label_key(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """add one value to a histogram"""
+        key = label_key(labels)
+        with self.lock:
+            bounds = self.buckets.setdefault(name, tuple(buckets))
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = [[0] * len(bounds), 0.0, 0]
+            entry = series[key]
+            for position, bound in enumerate(bounds):
+                if value <= bound:
+                    entry[0][position] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def set_profiling(self, directory):
+        """profile the next stages into directory, None switches profiling off"""
+        self.profile_dir = os.path.abspath(directory) if directory is not None else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """time a block as one pipeline stage
+
+        cpu is the CPU time of the whole process, so it also holds the
+        worker threads of the stage.  only the calling thread is profiled
+        """
+        profiler = None
+        profile_dir = self.profile_dir
+        with self.lock:
+            if profile_dir is not None and not self.profiling:
+                self.profiling = True
+                profiler = cProfile.Profile()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+
+            with self.lock:
+                timing = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                       "calls": 0})
+                timing["wall_seconds"] += wall
+                timing["cpu_seconds"] += cpu
+                timing["calls"] += 1
+
+            if profiler is not None:
+                os.makedirs(profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(profile_dir, name + ".prof"))
+                with self.lock:
+                    self.profiling = False
+
+    def total(self, name, **labels):
+        """sum of a counter over the series matching labels"""
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(value for key, value in self.counters.get(name, {}).items()
+                       if wanted <= set(key))
+
+    def summary(self):
+        """every metric as a JSON serializable dict"""
+        hits = self.total("search_cache_lookups", result="hit")
+        lookups = self.total("search_cache_lookups")
+
+        with self.lock:
+            counters = {name: [{"labels": dict(key), "value": value}
+                               for key, value in sorted(series.items())]
+                        for name, series in sorted(self.counters.items())}
+            histograms = {}
+            for name, series in sorted(self.histograms.items()):
+                histograms[name] = []
+                for key, (counts, total, count) in sorted(series.items()):
+                    histograms[name].append({
+                        "labels": dict(key),
+                        "buckets": {str(bound): value
+                                    for bound, value in zip(self.buckets[name], counts)},
+                        "sum": total,
+                        "count": count,
+                        "mean": total / count if count else 0.0})
+            stages = {name: dict(timing) for name, timing in self.stages.items()}
+
+        return {"stages": stages,
+                "counters": counters,
+                "histograms": histograms,
+                "search_cache_hit_rate": hits / lookups if lookups else None}
+
+    def prometheus(self):
+        """every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                metric = PROMETHEUS_PREFIX + name + "_total"
+                lines.append("# TYPE %s counter" % metric)
+                for key, value in sorted(series.items()):
+                    lines.append("%s%s %s" % (metric, prometheus_labels(key), value))
+
+            for name, series in sorted(self.histograms.items()):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append("# TYPE %s histogram" % metric)
+                for key, (counts, total, count) in sorted(series.items()):
+                    cumulative = 0
+                    for bound, value in zip(self.buckets[name], counts):
+                        cumulative += value
+                        lines.append("%s_bucket%s %i" % (
+                            metric, prometheus_labels(key, [("le", repr(float(bound)))]),
+                            cumulative))
+                    lines.append("%s_bucket%s %i" % (
+                        metric, prometheus_labels(key, [("le", "+Inf")]), count))
+                    lines.append("%s_sum%s %r" % (metric, prometheus_labels(key), total))
+                    lines.append("%s_count%s %i" % (metric, prometheus_labels(key), count))
+
+            for field in ("wall_seconds", "cpu_seconds"):
+                metric = PROMETHEUS_PREFIX + "stage_" + field
+                lines.append("# TYPE %s gauge" % metric)
+                for name, timing in sorted(self.stages.items()):
+                    lines.append("%s{stage=\"%s\"} %r" % (metric, name, timing[field]))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, prometheus_path=None):
+        """write the JSON summary, and the Prometheus text when prometheus_path is set"""
+        with open(path, "w") as fout:
+            json.dump(self.summary(), fout, indent=2)
+        if prometheus_path is not None:
+            with open(prometheus_path, "w") as fout:
+                fout.write(self.prometheus())
+
+    def snapshot(self, reset=False):
+        """copy of the raw metrics, merged by the process that started this one"""
+        with self.lock:
+            state = copy.deepcopy((self.counters, self.histograms, self.buckets, self.stages))
+        if reset:
+            self.reset()
+        return state
+
+    def merge(self, state):
+        """add the snapshot of another process, its stage times add up with ours"""
+        counters, histograms, buckets, stages = state
+        with self.lock:
+            for name, series in counters.items():
+                values = self.counters.setdefault(name, {})
+                for key, value in series.items():
+                    values[key] = values.get(key, 0) + value
+
+            for name, series in histograms.items():
+                self.buckets.setdefault(name, buckets[name])
+                own = self.histograms.setdefault(name, {})
+                for key, (counts, total, count) in series.items():
+                    if key not in own:
+                        own[key] = [[0] * len(counts), 0.0, 0]
+                    entry = own[key]
+                    entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                    entry[1] += total
+                    entry[2] += count
+
+            for name, timing in stages.items():
+                own = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                    "calls": 0})
+                for field, value in timing.items():
+                    own[field] += value
+
+    def reset(self):
+        """forget every recorded metric"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.buckets = {}
+            self.stages = {}
+
+
+_METRICS = Metrics()
+
+
+def get_metrics():
+    """return the registry shared by the whole process"""
+    return _METRICS
+
+
+def count(name, amount=1, **labels):
+    _METRICS.count(name, amount, **labels)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    _METRICS.observe(name, value, buckets, **labels)
+
+
+def stage(name):
+    return _METRICS.stage(name)
+
+
+def set_profiling(directory):
+    _METRICS.set_profiling(directory)
@@ -0,0 +1,258 @@
+"""ncei_async module runs the NCEI search and data requests on one asyncio event loop
+
+AsyncClient keeps one pooled aiohttp session.  A semaphore bounds the
+requests in flight, and every request has a connect and read timeout.  The
+rate limiting, retries and metrics are the ones of ncei_client, by default
+the client shares the limiter of ncei_client with the threaded requests.
+Cancelling a search or a download closes its open requests.  aiohttp is
+optional, only this module needs it.
+"""
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is optional, the rest of the scripts use requests
+    aiohttp = None
+
+import ncei_client
+import metrics
+import search_api
+
+# requests in flight at the same time by default
+CONCURRENCY = 100
+
+
+async def wait_for_slot(limiter):
+    """wait for the next free slot of an ncei_client limiter without blocking the loop"""
+    delay = limiter.reserve()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class AsyncClient:
+    """pooled aiohttp session of the search v1 and data v1 endpoints
+
+    used as `async with AsyncClient() as client:`.  without rate the
+    limiter of ncei_client is shared, with its current rate, its waits for
+    Retry-After and the slow-downs learned by earlier requests.  timeout is
+    (connect, read) in seconds
+    """
+
+    def __init__(self, rate=None, concurrency=CONCURRENCY, timeout=ncei_client.TIMEOUT,
+                 retries=ncei_client.RETRIES):
+        if aiohttp is None:
+            raise ImportError("ncei_async needs aiohttp, install it with pip install aiohttp")
+
+        if rate is None:
+            self.limiter = ncei_client.get_limiter()
+        else:
+            self.limiter = ncei_client.RateLimiter(rate)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.session = None
+        self.slots = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def client_timeout(self, timeout):
+        connect, read = timeout
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    def open(self):
+        """create the session, inside the running event loop"""
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.concurrency)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=self.client_timeout(self.timeout))
+        self.slots = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_json(self, url, parameters, timeout=None):
+        """GET an NCEI url, return the status and the decoded answer
+
+        429 and 5xx answers, connection errors and timeouts are retried like
+        ncei_client.get.  timeout overrides the (connect, read) timeout of
+        the client for this request
+        """
+        endpoint = ncei_client.endpoint_name(url)
+        options = {}
+        if timeout is not None:
+            options["timeout"] = self.client_timeout(timeout)
+
+        for attempt in range(self.retries + 1):
+            await wait_for_slot(self.limiter)
+            started = time.perf_counter()
+            try:
+                async with self.slots:
+                    async with self.session.get(url, params=parameters, **options) as response:
+                        body = await response.read()
+                        status = response.status
+                        retry_after = ncei_client.retry_after_seconds(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                delay = ncei_client.request_failed(error, attempt, self.retries, endpoint)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            metrics.count("ncei_bytes", len(body), endpoint=endpoint)
+            delay = ncei_client.request_answered(status, retry_after, started, attempt,
+                                                 self.retries, endpoint, self.limiter)
+            if delay is None:
+                return status, json.loads(body)
+
+            await asyncio.sleep(delay)
+
+    async def search(self, bbox, dataset, startdate, enddate, dump_path=None):
+        """every station of one bbox page by page
+
+        raises search_api.SearchAPIError if the API reported an error
+        """
+        stations = []
+        offset = 0
+        while offset is not None:
+            status, answer = await self.get_json(
+                search_api.SEARCH_URL,
+                search_api.search_parameters(bbox, dataset, startdate, enddate, offset))
+
+            page = search_api.read_search_answer(answer, status, dump_path)
+            stations.extend(page)
+            offset = search_api.next_offset(answer, offset, page)
+
+        return stations
+
+    async def search_point(self, latitude, longitude, startdate, enddate, attributes,
+                           bbox_max=100, dataset="daily-summaries", cache=None, dump_path=None,
+                           **options):
+        """search_api.search_stations with the request of the largest box on the loop
+
+        options are passed on to search_stations
+        """
+        length = search_api.largest_length(bbox_max)
+        bounds = search_api.bbox_bounds(latitude, longitude, length)
+
+        stations = None
+        if cache is not None:
+            stations = cache.get(dataset, startdate, enddate, bounds)
+
+        if stations is None:
+            # the grid box around the point, like search_api.box_stations
+            request_bounds = search_api.snap_bounds(bounds)
+            stations = await self.search(search_api.bbox_string(request_bounds),
+                                         dataset, startdate, enddate, dump_path)
+            if cache is not None:
+                cache.put(dataset, startdate, enddate, request_bounds, stations)
+            stations = search_api.filter_stations(stations, bounds)
+
+        return search_api.search_stations(latitude, longitude, startdate, enddate, attributes,
+                                          bbox_max, dataset, dump_path=dump_path,
+                                          all_stations=stations, **options)
+
+    async def search_points(self, points, startdate, enddate, attributes, **options):
+        """search every (latitude, longitude) of points at the same time
+
+        returns the results in the order of points, a point whose search
+        failed holds its exception
+        """
+        return await asyncio.gather(
+            *(self.search_point(latitude, longitude, startdate, enddate, attributes, **options)
+              for latitude, longitude in points),
+            return_exceptions=True)
+
+    async def station_data(self, station_ids, dataset, startdate, enddate, data_types=None):
+        """records of several stations in one data request, station id -> records"""
+        status, data = await self.get_json(
+            search_api.DATA_URL,
+            search_api.station_parameters(','.join(station_ids), dataset, startdate, enddate,
+                                          data_types))
+        if status != 200 or not isinstance(data, list):
+            raise ValueError("data API returned an error (status %i)" % status, data)
+        metrics.count("records_downloaded", len(data))
+
+        return search_api.split_by_station(data, station_ids)
+
+    async def fetch_chunk(self, station_ids, dataset, chunk, retries=2, data_types=None):
+        """request one date range of a batch of stations, retrying it alone when it fails"""
+        for attempt in range(retries + 1):
+            try:
+                return await self.station_data(station_ids, dataset, chunk[0], chunk[1],
+                                               data_types)
+            except (OSError, ValueError, aiohttp.ClientError) as error:
+                if attempt == retries:
+                    raise
+                logging.warning("Retrying station(s) %s for %s - %s: %s",
+                                ','.join(station_ids), chunk[0], chunk[1], error)
+
+    async def fetch_stations(self, station_ids, dataset, startdate, enddate, data_path,
+                             on_fetched=None, chunk_days=None, batch=False, retries=2,
+                             data_types=None):
+        """search_api.fetch_stations_data on the event loop
+
+        every chunk of every batch is one task.  a station is merged and
+        saved under data_path once all of its chunks arrived.  returns the
+        stations that were saved, the open requests are cancelled when the
+        call ends
+        """
+        chunks = [(startdate, enddate)]
+        if chunk_days is not None:
+            chunks = search_api.split_date_range(startdate, enddate, chunk_days)
+        download = search_api.ChunkedDownload(station_ids, chunks, batch)
+
+        tasks = {asyncio.ensure_future(self.fetch_chunk(batch_ids, dataset, chunk, retries,
+                                                        data_types)):
+                 (batch_ids, position)
+                 for batch_ids, position, chunk in download.requests()}
+
+        fetched = []
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    batch_ids, position = tasks[task]
+                    try:
+                        completed = download.received(batch_ids, position, task.result())
+                    except (OSError, ValueError, aiohttp.ClientError) as error:
+                        completed = download.received(batch_ids, position, error=error)
+
+                    for station_id, station_chunks in completed:
+                        if station_chunks is None:
+                            continue
+                        # the file is written off the loop, the requests keep going
+                        await asyncio.to_thread(search_api.save_station_data,
+                                                search_api.merge_records(station_chunks),
+                                                station_id, data_path)
+                        fetched.append(station_id)
+                        if on_fetched is not None:
+                            on_fetched(station_id)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return fetched
+
+
+def fetch_stations_data(station_ids, dataset, startdate, enddate, data_path,
+                        concurrency=CONCURRENCY, on_fetched=None, chunk_days=None, batch=False,
+                        rate=None, data_types=None):
+    """download the stations on a new event loop, for callers without one"""
+    async def fetch():
+        async with AsyncClient(rate, concurrency) as client:
+            return await client.fetch_stations(station_ids, dataset, startdate, enddate,
+                                               data_path, on_fetched, chunk_days, batch,
+                                               data_types=data_types)
+
+    return asyncio.run(fetch())
@@ -0,0 +1,215 @@
+"""ncei_client module shares one keep-alive http session between the NCEI requests
+
+Every request goes through one token bucket.  It halves its rate when NCEI
+answers 429/503 (waiting for Retry-After when given) and slowly climbs back
+to the configured rate while requests succeed.  Failed requests are retried
+with exponential backoff and jitter.
+"""
+import email.utils
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# least number of keep-alive connections kept open per host, get_session
+# makes the pool larger for more download workers
+POOL_SIZE = 32
+
+# requests per second allowed by default and the number of retries of a request
+DEFAULT_RATE = 5.0
+RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 60.0  # seconds
+TIMEOUT = (10, 300)  # connect and read timeouts in seconds
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+SLOW_DOWN_STATUS = {429, 503}
+
+_SESSION = None
+_SESSION_POOL_SIZE = 0
+_SESSION_LOCK = threading.Lock()
+
+
+class RateLimiter:
+    """token bucket that adapts to the answers of the server"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None, min_rate=0.2):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """take the next slot and return the seconds to wait for it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+
+        return wait
+
+    def acquire(self):
+        """wait for the next free slot"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def slow_down(self, retry_after=None):
+        """halve the rate, and stop every request for retry_after seconds"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            metrics.count("ncei_slow_downs")
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        logging.warning("NCEI asked to slow down, now %.2f request(s) per second", self.rate)
+
+    def speed_up(self):
+        """climb back towards the configured rate after a success"""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+_LIMITER = RateLimiter()
+
+
+def get_session(workers=0):
+    """return the shared session, created on first use
+
+    the connection pool keeps at least max(POOL_SIZE, workers) connections,
+    the session is made again with a larger pool when more workers need it
+    """
+    global _SESSION, _SESSION_POOL_SIZE
+    pool_size = max(POOL_SIZE, workers)
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_POOL_SIZE < pool_size:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSION = session
+            _SESSION_POOL_SIZE = pool_size
+        return _SESSION
+
+
+def get_limiter():
+    """return the limiter shared by every request"""
+    return _LIMITER
+
+
+def set_rate(rate):
+    """change the number of requests per second allowed"""
+    global _LIMITER
+    _LIMITER = RateLimiter(rate)
+
+
+def retry_after_seconds(response):
+    """seconds asked by the Retry-After header, None when there is none"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff(attempt):
+    """exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def endpoint_name(url):
+    """short name of an NCEI url used as metrics label"""
+    return "search" if "/search/" in url else "data"
+
+
+def request_failed(error, attempt, retries, endpoint):
+    """count a request that got no answer
+
+    returns the seconds to wait before the next attempt, None once the
+    retries are used up.  shared with the asyncio client
+    """
+    metrics.count("ncei_requests", endpoint=endpoint, status="error")
+    if attempt == retries:
+        return None
+
+    delay = backoff(attempt)
+    metrics.count("ncei_retries", endpoint=endpoint)
+    logging.warning("Request failed (%s), retrying in %.1f s", error, delay)
+    return delay
+
+
+def request_answered(status, retry_after, started, attempt, retries, endpoint, limiter):
+    """count an answer and adapt the limiter to it
+
+    returns the seconds to wait before the request is retried, None when
+    the answer is final.  shared with the asyncio client
+    """
+    metrics.observe("ncei_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+    metrics.count("ncei_requests", endpoint=endpoint, status=status)
+
+    if status not in RETRY_STATUS:
+        limiter.speed_up()
+        return None
+
+    if status in SLOW_DOWN_STATUS:
+        limiter.slow_down(retry_after)
+    if attempt == retries:
+        return None
+
+    metrics.count("ncei_retries", endpoint=endpoint)
+    delay = max(backoff(attempt), retry_after or 0.0)
+    logging.warning("Status Code %i Recieved, retrying in %.1f s", status, delay)
+    return delay
+
+
+def get(url, parameters, session=None, stream=False, retries=RETRIES):
+    """GET an NCEI url through the shared session and limiter
+
+    429 and 5xx answers and connection errors are retried, the last
+    answer is returned once the retries are used up
+    """
+    if session is None:
+        session = get_session()
+    endpoint = endpoint_name(url)
+
+    for attempt in range(retries + 1):
+        _LIMITER.acquire()
+        started = time.perf_counter()
+        try:
+            response = session.get(url, params=parameters, stream=stream, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            delay = request_failed(error, attempt, retries, endpoint)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+
+        if not stream:  # streamed bodies are counted by whoever reads them
+            metrics.count("ncei_bytes", len(response.content), endpoint=endpoint)
+
+        delay = request_answered(response.status_code, retry_after_seconds(response), started,
+                                 attempt, retries, endpoint, _LIMITER)
+        if delay is None:
+            return response
+
+        response.close()
+        time.sleep(delay)
@@ -1,355 +1,1032 @@
 """search_api module"""
 import json
 import math
-import time
+import datetime
 import logging
+import functools
 import argparse
 import copy
 import sys
-import re
 import os
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import ncei_client
+import metrics
+from search_cache import SearchCache, DEFAULT_TTL
+from station_inventory import StationInventory, haversine
+from json_stream import iter_json_array, write_json_array, CHUNK_BYTES
 
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+SEARCH_URL = "https://www.ncei.noaa.gov/access/services/search/v1/data"
+DATA_URL = "https://www.ncei.noaa.gov/access/services/data/v1"
 
+RADIUS = 6371.0
+STARTING_LEN = 1
 
-# given test query parameters
-parser = argparse.ArgumentParser(
-    description='Query the NCEI API with given arguments.')
-
-group1 = parser.add_argument_group('Required', 'Required arguments')
-group1.add_argument('-d', '--dataset', type=str, required=True,
-                    help='Dataset to search through.  Found in NCEI documentation or site.')
-group1.add_argument('-la', '--latitude', type=float, required=True,
-                    help='Latitude of the source point')
-
-group1.add_argument('-lo', '--longitude', type=float, required=True,
-                    help='Longitude of the source point')
-
-group1.add_argument('-sd', '--startdate', type=str, required=True,
-                    help='startDate in YYYY-MM-DD format')
-
-group1.add_argument('-ed', '--enddate', type=str, required=True,
-                    help="endDate in YYYY-MM-DD format")
+# the largest box of a point is requested snapped outwards to a grid of
+# this many degrees and padded by one step, so the boxes of neighbouring
+# points fall inside the box cached for the first of them
+SEARCH_GRID = 0.25
 
-group1.add_argument('-a', '--attributes', type=str, required=True,
-                    help='List of data types from NCEI.  1 minimum required',
-                    nargs='+')
+# stations per page of the search API, larger answers are requested page by page
+SEARCH_PAGE = 1000
 
-group2 = parser.add_argument_group('Optional', 'Optional arguments')
-HELP_STRING = "maximum length of the boundingbox in km.  defaults to 100."
-group2.add_argument('-b', '--bboxsize', type=float,
-                    help=HELP_STRING, default=100)
+# size limits of a multi-station data request
+MAX_BATCH = 25
+MAX_STATION_DAYS = 25 * 366
 
-group2.add_argument('-s', '--stationspath', type=str,
-                    default="data/stations_sorted.json",
-                    help='sorted stations path.  default: "data/stations_sorted.json"')
 
-group2.add_argument('-dp', '--datapath', type=str,
-                    default="data/stations/",
-                    help='path for the actual data.  default: "data/stations/"')
+class SearchError(Exception):
+    """raised when the search cannot return any station"""
 
-group2.add_argument('-dmp', '--dumpraw', action='store_true',
-                    default=False,
-                    help='Dump the raw search and error results and to the dump path under name search.json/error.json respectively')
 
-group2.add_argument('-dmppath', '--dumppath', type=str,
-                    default="data/raw/",
-                    help='path for the raw search data.  default: "data/raw/"')
+class SearchAPIError(SearchError):
+    """raised when the search API answers with an error instead of stations"""
 
-group2.add_argument('-i', '--includeincomplete', action='store_true',
-                    help='Store stations with attributes present, but for dates outside the request')
-group2.add_argument('-na', '--noattributes',  action='store_true',
-                    help="when set it will search for attributes and will return the first applicable station.  Useful for finding attributes in a dataset.")
 
-args = parser.parse_args()
+# Calculating the corners of the bounding box based on length
+# returns (north, west, south, east)
+def bbox_bounds(latitude, longitude, length):
+    """calculate the corners of the bbox"""
+    box_lat_len = length * (360 / 40075)
+    # long is depended on lat
+    box_long_len = length * (360 / (math.cos(math.radians(latitude)) * 40075))
 
-LATITUDE = args.latitude
-LONGITUDE = args.longitude
-SORTEDSTATIONSFILEPATH = args.stationspath
-BBOXSIZE = args.bboxsize
-ATTRIBUTES = args.attributes
-STARTDATE = args.startdate
-ENDDATE = args.enddate
-DATAFILEPATH = args.datapath
-DUMPRAW = args.dumpraw
-DUMPPATH = args.dumppath
-DATASET = args.dataset
-SAVEPARTIAL = args.includeincomplete
-NOATTRIBUTES = args.noattributes
+    return (box_lat_len + latitude, -box_long_len + longitude,
+            latitude - box_lat_len, longitude + box_long_len)
 
-RADIUS = 6371.0
-RADLATITUDE = math.radians(float(LATITUDE))
-RADLONGITUDE = math.radians(float(LONGITUDE))
 
 # Calculating the size of the bounding box based on length
 # returns a string in the correct format for the API request
-def calculate_bbox(length):
+def calculate_bbox(latitude, longitude, length):
     """calculate the bbox and return it"""
-    box_lat_len = length * (360 / 40075)
-    # long is depended on lat
-    box_long_len = length * (360 / (math.cos(RADLATITUDE) * 40075))
+    return bbox_string(bbox_bounds(latitude, longitude, length))
+
+
+def bbox_string(bounds):
+    """(north, west, south, east) in the format of the API request"""
+    north, west, south, east = bounds
 
     # upper left coordinates of the box
-    upper_left = str(box_lat_len + LATITUDE) + ', ' + \
-        str(-box_long_len + LONGITUDE)
+    upper_left = str(north) + ', ' + str(west)
 
     # lower right coordinates of the box
-    lower_right = str(LATITUDE - box_lat_len) + ', ' + \
-        str(LONGITUDE + box_long_len)
+    lower_right = str(south) + ', ' + str(east)
 
     # combine into a format acceptable for an API request
     bbox = upper_left + ', ' + lower_right
 
     return bbox
 
+
+def build_command(latitude, longitude, startdate, enddate, attributes,
+                  bbox_max, dataset):
+    """equivalent search_api.py command line, stored in the metadata"""
+    return "search_api.py -d " + dataset + " -sd " + startdate + " -ed " + enddate + \
+        " -la " + str(latitude) + " -lo " + str(longitude) + \
+        " -a " + ' '.join(attributes) + " -b " + str(bbox_max)
+
+
+def dump_raw(dump_path, name, data):
+    """dump a raw api response under the dump path"""
+    if not os.path.exists(dump_path):
+        os.makedirs(dump_path)
+    with open(os.path.join(dump_path, name), 'w') as fout:
+        print(json.dumps(data, indent=2), file=fout)
+
+
+# Turn the results of the search API into the station entries we store
+def parse_results(results):
+    """parse the stations out of the search results"""
+    stations = []
+    attributes = []
+    for station in results:
+        short_station = station['stations'][0]
+
+        # clear attributes from prev station
+        attributes.clear()
+        for attribute in short_station['dataTypes']:
+            attributes.append(
+                {'id': attribute['id'],
+                 'dateRange': attribute['dateRange']})
+
+        # Add the station entry to the final list
+        station_latitude = station['location']['coordinates'][1]
+        station_longitude = station['location']['coordinates'][0]
+        stations.append(
+            {"station": short_station['id'],
+             "dataTypes": copy.deepcopy(attributes),
+             'latitude': station_latitude,
+             'longitude': station_longitude
+             })
+
+    return stations
+
+
+def search_parameters(bbox, dataset, startdate, enddate, offset=0):
+    """parameters of the search API for one page of a bbox"""
+    return {'dataset': dataset,
+            'bbox': bbox,
+            'startDate': startdate, 'endDate': enddate,
+            'limit': str(SEARCH_PAGE),
+            'offset': str(offset),
+            # 'text': DATASET,
+            # 'available': 'true'
+            }
+
+
+def next_offset(answer, offset, stations):
+    """offset of the next page of a search, None once every station was returned"""
+    offset += len(stations)
+    if len(stations) == 0 or offset >= answer.get('count', 0):
+        return None
+    return offset
+
+
+# Read the answer of the search API, shared with the asyncio client
+# raises SearchAPIError if the API reported an error
+def read_search_answer(answer, status_code, dump_path=None):
+    """parse the stations out of a search answer"""
+    # try request necessary for Exception thrown when there is no station
+    try:
+        # results is a list of stations
+        stations = parse_results(answer["results"])
+
+    # Process no stations present Exception
+    except KeyError:
+        if dump_path is not None:
+            dump_raw(dump_path, "error.json", answer)
+        if status_code == 200 and "errorCode" not in answer:
+            logging.info("No stations present in current search.")
+            return []
+
+        if answer.get("errorCode") in (400, 500):
+            logging.error(
+                "Check your dataset if it appears to be timing out")
+        logging.error(
+            'Status Code %i Recieved', status_code)
+        logging.error("		%s", answer.get('errorMessage'))
+        for error in answer.get('errors', []):
+            logging.error("		%s", error['message'])
+        raise SearchAPIError(answer.get('errorMessage', "status %i" % status_code))
+
+    if len(stations) > 0 and dump_path is not None:
+        dump_raw(dump_path, "search.json", answer)
+
+    return stations
+
+
+# Request every station of one bbox from the search API, page by page
+# so a dense box is never cut at the first page. raises SearchAPIError if
+# the API reported an error
+def request_stations(bbox, dataset, startdate, enddate, dump_path=None):
+    """request stations from API function"""
+    stations = []
+    offset = 0
+    while offset is not None:
+        # trying not to get blacklisted, ncei_client throttles and retries every request
+        response = ncei_client.get(SEARCH_URL,
+                                   search_parameters(bbox, dataset, startdate, enddate, offset))
+        answer = response.json()
+
+        page = read_search_answer(answer, response.status_code, dump_path)
+        stations.extend(page)
+        offset = next_offset(answer, offset, page)
+
+    return stations
+
+
+def snap_bounds(bounds, grid=SEARCH_GRID):
+    """bounds grown outwards to the grid and padded by one grid step
+
+    the padding stops at the poles and at the antimeridian, the box is
+    never smaller than bounds
+    """
+    north, west, south, east = bounds
+    return (min(max(90.0, north), math.ceil(north / grid) * grid + grid),
+            max(min(-180.0, west), math.floor(west / grid) * grid - grid),
+            max(min(-90.0, south), math.floor(south / grid) * grid - grid),
+            min(max(180.0, east), math.ceil(east / grid) * grid + grid))
+
+
+# Stations inside a bbox, answered from the cache when it can. with snap
+# the request covers the grid box around it, which is what gets cached
+# raises SearchAPIError if the API reported an error
+def box_stations(length, latitude, longitude, dataset, startdate, enddate,
+                 dump_path=None, cache=None, snap=False):
+    """request the stations of one bbox"""
+    bounds = bbox_bounds(latitude, longitude, length)
+    request_bounds = snap_bounds(bounds) if snap else bounds
+    bbox = bbox_string(request_bounds)
+
+    # Print the request to be sent
+    logging.info('Requesting data for:')
+    logging.info('		Dataset : %s', dataset)
+    logging.info('		Date Range : %s - %s', startdate, enddate)
+    logging.info('      %f sqkm box at coordinates : %s', length**2, bbox)
+
+    stations = None
+    if cache is not None:
+        stations = cache.get(dataset, startdate, enddate, bounds)
+        if stations is not None:
+            logging.info('      answered from the search cache')
+
+    if stations is None:
+        stations = request_stations(bbox, dataset, startdate, enddate, dump_path)
+        if cache is not None:
+            cache.put(dataset, startdate, enddate, request_bounds, stations)
+        if snap:
+            stations = filter_stations(stations, bounds)
+
+    return stations
+
+
+def filter_stations(stations, bounds):
+    """stations of a larger search that lie inside bounds"""
+    north, west, south, east = bounds
+    return [station for station in stations
+            if south <= station['latitude'] <= north
+            and west <= station['longitude'] <= east]
+
+
+def largest_length(bbox_max):
+    """largest box length reached by doubling STARTING_LEN within bbox_max"""
+    length = STARTING_LEN
+    while length * 2 <= bbox_max:
+        length *= 2
+    return length
+
+
 # Set the parameters and iterate through increasing the bbox length
-# until the desired station(s) are returned
-def find_station(length):
+# until the desired station(s) are returned. when the stations of the
+# largest box are given every bbox is filtered out of them locally
+def find_station(length, latitude, longitude, dataset, startdate, enddate,
+                 bbox_max, dump_path=None, command=None, cache=None, all_stations=None):
     """find stations from API function """
-    station_found = False
-    while station_found is False:
-        bbox = calculate_bbox(length)
-
-    # given test query parameters
-        parameters = {'dataset': DATASET,
-                      'bbox': bbox,
-                      'startDate': STARTDATE, 'endDate': ENDDATE,
-                      # 'text': DATASET,
-                      # 'limit': '10',
-                      # 'offset': '0',
-                      # 'available': 'true'
-                      }
-
-    # request with parameters
-
-        # trying not to get blacklisted
-
-        # Print the request to be sent
-        logging.info('Requesting data for:')
-        logging.info('		Dataset : %s', DATASET)
-        logging.info('		Date Range : %s - %s', STARTDATE, ENDDATE)
-        logging.info('      %f sqkm box at coordinates : %s', length**2, bbox)
-
-        time.sleep(0.10)
-        response = requests.get(
-            "https://www.ncei.noaa.gov/access/services/search/v1/data",
-            parameters)
-
-        # try request necessary for Exception thrown when there is no station
-        stations = []
-        station_data = {"stations": [], "metadata": {}}
-        station_data["metadata"]["command"] = (' '.join(sys.argv[0:]))
-        attributes = []
-        try:
-            # results is a list of stations
-
-            for station in response.json()["results"]:
-                short_station = station['stations'][0]
-
-                # track the stations for passing to other scripts later
-                stations.append(short_station['id'])
-
-                # clear attributes from prev station
-                attributes.clear()
-                for attribute in short_station['dataTypes']:
-                    attributes.append(
-                        {'id': attribute['id'],
-                         'dateRange': attribute['dateRange']})
-
-                # Add the station entry to the final list
-                latitude = station['location']['coordinates'][1]
-                longitude = station['location']['coordinates'][0]
-                station_data["stations"].append(
-                    {"station": short_station['id'],
-                     "dataTypes": copy.deepcopy(attributes),
-                     'latitude': latitude,
-                     'longitude': longitude
-                     })
-
-        # Process no stations present Exception
-        except KeyError:
-            if DUMPRAW is True:
-                if not os.path.exists(DUMPPATH):
-                    os.makedirs(DUMPPATH)
-                with open(DUMPPATH + "error.json", 'w') as fout:
-                    print(json.dumps(response.json(), indent=2), file=fout)
-            try:
-                if(response.json()["errorCode"] == 400 |
-                        response.json()["errorCode"] == 500):
-                    logging.error(
-                        "Check your dataset if it appears to be timing out")
-
-                    logging.error(
-                        'Status Code %i Recieved', response.status_code)
-                    logging.error("		%s", response.json()['errorMessage'])
-                    for error in response.json()['errors']:
-                        logging.error("		%s", error['message'])
-                    sys.exit()
-            except KeyError:
-                logging.info("No stations present in current search.")
+    while True:
+        if all_stations is not None:
+            stations = filter_stations(all_stations, bbox_bounds(latitude, longitude, length))
+        else:
+            stations = box_stations(length, latitude, longitude, dataset, startdate,
+                                    enddate, dump_path, cache)
 
         # Exit as soon as 1 or more stations are present in the Bounding box
         # here would be a good place to scan through the station list for
         # required attributes if we need certain ones.
-        if len(stations) > 0:
-            station_found = True
-            if DUMPRAW is True:
-                if not os.path.exists(DUMPPATH):
-                    os.makedirs(DUMPPATH)
-                with open(DUMPPATH + "search.json", 'w') as fout:
-                    print(json.dumps(response.json(), indent=2), file=fout)
+        if stations:
+            station_data = {"stations": stations, "metadata": {}}
+            station_data["metadata"]["command"] = command
             return station_data
 
         # double the size of the box leßngth if nothing is present
         length *= 2
 
         # Exceeded set boundingbox size
-        if length > BBOXSIZE:
+        if length > bbox_max:
             logging.warning("Search exceeded maximum box length.")
             logging.warning("Adjust search criteria.")
-            sys.exit()
-
-
-STARTING_LEN = 1
-station_data_raw = find_station(STARTING_LEN)
+            raise SearchError("Search exceeded maximum box length.")
 
 
 def sort_function(given_station):  # Function for sorting the entries by distance
     """sorting function"""
     return given_station["distance"]
 
+# Ordinal day of an API date, the same dates come back for many stations
+@functools.lru_cache(maxsize=None)
+def date_ordinal(text):
+    """ordinal day of a YYYY-MM-DD or YYYY-MM-DDThh:mm:ss date"""
+    return datetime.date.fromisoformat(text[:10]).toordinal()
+
+
+def attribute_index(stations):
+    """one row per data type of every station
+
+    returns the station positions, data type ids and the first and last
+    day of every data type as arrays
+    """
+    positions = []
+    ids = []
+    starts = []
+    ends = []
+    for position, station in enumerate(stations):
+        for data_type in station["dataTypes"]:
+            positions.append(position)
+            ids.append(data_type['id'])
+            starts.append(date_ordinal(data_type["dateRange"]["start"]))
+            ends.append(date_ordinal(data_type["dateRange"]["end"]))
+
+    return (np.array(positions, dtype=int), np.array(ids, dtype=str),
+            np.array(starts, dtype=int), np.array(ends, dtype=int))
+
+
 # Scan the stations for necessary attributes in the correct date range
-def check_attributes(given_data, given_dict):
+def check_attributes(given_data, given_dict, startdate, enddate, save_partial=False):
     """check attributes of current dataset"""
     returning_stations = {"stations": []}
     returning_stations["metadata"] = copy.deepcopy(given_data["metadata"])
-    for station in given_data["stations"]:
-        for data_type in station["dataTypes"]:
-            if data_type['id'] in given_dict:
-                # regex the date format
-                start_string = data_type["dateRange"]["start"]
-                end_string = data_type["dateRange"]["end"]
-                pattern = '(.*)T'
-                start_result = re.match(pattern, start_string)
-                end_result = re.match(pattern, end_string)
-
-                # check the dates
-                if (time.strptime(start_result.group(1), "%Y-%m-%d") <= time.strptime(STARTDATE, "%Y-%m-%d")) & \
-                        (time.strptime(end_result.group(1), "%Y-%m-%d") >= time.strptime(ENDDATE, "%Y-%m-%d")):
-                    # Valid for the range
-                    given_dict[data_type['id']] = True
-                    if station not in returning_stations["stations"]:
-                        returning_stations["stations"].append(station)
-                else: # if not valid print a warning
-                    logging.warning("dataType %s is present only for date range %s - %s for station %s",
-                                    data_type['id'], start_result.group(1), end_result.group(1), station["station"])
-                    if SAVEPARTIAL is True: # save if -i flag is asserted
-                        logging.warning(
-                            "-i flag asserted, station %s data saved!", station['station'])
-                        given_dict[data_type['id']] = True
-                        if station not in returning_stations["stations"]:
-                            returning_stations["stations"].append(station)
-    return returning_stations
 
-# if searching for certain attributes check current stations and then
-# re-iterate through the find_station function until either the bbox limit
-# is reached or you find at least 1 station with the right attribute and dates
-if NOATTRIBUTES is False:
-    # Create a dictionary for marking discovered attributes
-    attributeSetDefaults = [False] * len(ATTRIBUTES)
-    attribute_dict = dict(zip(ATTRIBUTES, attributeSetDefaults))
-
-    # Check the first return of data for the correct attributes
-    returned_stations = check_attributes(station_data_raw, attribute_dict)
-
-    # Scan the marked up dictionary tracking the attributes that aren't gathered
-    LOOKUP_VALUE = False
-    falseEntries = []
-    for key, value in attribute_dict.items():
-        if value == LOOKUP_VALUE:
-            falseEntries.append(key)
-
-    # if we have not exceeded the bbox and are missing attributes extend the base search
-    while (STARTING_LEN * 2 <= BBOXSIZE) & (len(falseEntries) > 0):
-        STARTING_LEN = STARTING_LEN * 2
-
-        logging.info(
-            "expanding search for Attributes %s with length %i", ','.join(ATTRIBUTES), STARTING_LEN)
-
-        # rerun the search and attribute marking
-        station_dataRaw = find_station(STARTING_LEN)
-        returned_stations = check_attributes(station_dataRaw, attribute_dict)
-
-        # Rescan the attribute Dictionary
-        falseEntries.clear()
-        for key, value in attribute_dict.items():
-            if value == LOOKUP_VALUE:
-                falseEntries.append(key)
-
-    # All attributes have been found
-    if len(falseEntries) == 0:
-        logging.info("All attributes are included!")
-    else:  # not all attributes were found, and met edge of bbox
-        logging.info(
-            "Attributes: %s are not found in given bounding box!", ','.join(falseEntries))
-else:
-    # return the base data if no attributes are requested
-    returned_stations = station_data_raw
+    stations = given_data["stations"]
+    positions, ids, starts, ends = attribute_index(stations)
+
+    # check the dates of every requested data type at once
+    wanted = np.isin(ids, list(given_dict))
+    valid = wanted & (starts <= date_ordinal(startdate)) & (ends >= date_ordinal(enddate))
+    partial = wanted & ~valid
+
+    # if not valid print a warning
+    for row in np.nonzero(partial)[0]:
+        station = stations[positions[row]]
+        data_type = station["dataTypes"][row - np.searchsorted(positions, positions[row])]
+        logging.warning("dataType %s is present only for date range %s - %s for station %s",
+                        ids[row], data_type["dateRange"]["start"][:10],
+                        data_type["dateRange"]["end"][:10], station["station"])
+        if save_partial is True:  # save if -i flag is asserted
+            logging.warning(
+                "-i flag asserted, station %s data saved!", station['station'])
+
+    selected = valid | partial if save_partial is True else valid
+
+    # Valid for the range
+    for data_type_id in set(ids[selected]):
+        given_dict[data_type_id] = True
+
+    returned = set()
+    for position in np.unique(positions[selected]):
+        station = stations[position]
+        if station["station"] not in returned:
+            returned.add(station["station"])
+            returning_stations["stations"].append(station)
+
+    return returning_stations
 
 
 # calculate distance from the given point for every station
-def distance_calc(given_stations):
+def distance_calc(given_stations, latitude, longitude):
     """calculate distance for each station present"""
-    for entry in given_stations:
-        # Calculate the distance in km from the point
+    if not given_stations:
+        return given_stations
+
+    # every distance in km at once, with the haversine of the inventory
+    distances = haversine(float(latitude), float(longitude),
+                          [float(entry['latitude']) for entry in given_stations],
+                          [float(entry['longitude']) for entry in given_stations])
+    for entry, distance in zip(given_stations, distances.tolist()):
+        entry.update({'distance': distance})
 
-        station_latitude = math.radians(float(entry['latitude']))
-        station_longitude = math.radians(float(entry['longitude']))
+    return given_stations
 
-        distance_lat = RADLATITUDE - station_latitude
-        distance_long = RADLONGITUDE - station_longitude
-        calc1 = math.sin(distance_lat / 2)**2 + math.cos(station_latitude) * \
-            math.cos(RADLATITUDE) * math.sin(distance_long / 2)**2
-        calc2 = 2 * math.atan2(math.sqrt(calc1), math.sqrt(1 - calc1))
-        distance = RADIUS * calc2
 
-        entry.update({'distance': distance})
+def search_stations(latitude, longitude, startdate, enddate, attributes,
+                    bbox_max=100, dataset="daily-summaries", save_partial=False,
+                    no_attributes=False, dump_path=None, command=None, cache=None,
+                    inventory=None, nearest=10, doubling=False, all_stations=None):
+    """search the stations around a point and return them sorted by distance
+
+    raises SearchError when no station is found inside bbox_max and its
+    subclass SearchAPIError when the search API answers with an error.
+    cache is an optional search_cache.SearchCache shared between
+    searches.  when a station_inventory.StationInventory is given the
+    `nearest` closest stations within bbox_max km are taken from it
+    without calling the API.
+
+    the largest bbox is requested once and the smaller boxes are filtered
+    out of it, giving the same stations as requesting every box size in
+    turn (doubling=True).  all_stations are the stations of the largest box
+    when they were already requested, by the asyncio client
+    """
+    if command is None:
+        command = build_command(latitude, longitude, startdate, enddate,
+                                attributes, bbox_max, dataset)
+
+    if inventory is not None:
+        return search_inventory(inventory, latitude, longitude, startdate, enddate,
+                                attributes, bbox_max, save_partial, no_attributes,
+                                command, nearest)
+
+    if doubling is False and all_stations is None:
+        all_stations = box_stations(largest_length(bbox_max), latitude, longitude, dataset,
+                                    startdate, enddate, dump_path, cache, snap=True)
+
+    length = STARTING_LEN
+    station_data_raw = find_station(length, latitude, longitude, dataset, startdate, enddate,
+                                    bbox_max, dump_path, command, cache, all_stations)
+
+    # if searching for certain attributes check current stations and then
+    # re-iterate through the find_station function until either the bbox limit
+    # is reached or you find at least 1 station with the right attribute and dates
+    if no_attributes is False:
+        # Create a dictionary for marking discovered attributes
+        attribute_set_defaults = [False] * len(attributes)
+        attribute_dict = dict(zip(attributes, attribute_set_defaults))
+
+        # Check the first return of data for the correct attributes
+        returned_stations = check_attributes(station_data_raw, attribute_dict,
+                                             startdate, enddate, save_partial)
+
+        # Scan the marked up dictionary tracking the attributes that aren't gathered
+        false_entries = [key for key, value in attribute_dict.items() if value is False]
+
+        # if we have not exceeded the bbox and are missing attributes extend the base search
+        while (length * 2 <= bbox_max) & (len(false_entries) > 0):
+            length = length * 2
+
+            logging.info(
+                "expanding search for Attributes %s with length %i", ','.join(attributes), length)
+
+            # rerun the search and attribute marking
+            station_data_raw = find_station(length, latitude, longitude, dataset,
+                                            startdate, enddate, bbox_max, dump_path, command,
+                                            cache, all_stations)
+            returned_stations = check_attributes(station_data_raw, attribute_dict,
+                                                 startdate, enddate, save_partial)
+
+            # Rescan the attribute Dictionary
+            false_entries = [key for key, value in attribute_dict.items() if value is False]
+
+        # All attributes have been found
+        if len(false_entries) == 0:
+            logging.info("All attributes are included!")
+        else:  # not all attributes were found, and met edge of bbox
+            logging.info(
+                "Attributes: %s are not found in given bounding box!", ','.join(false_entries))
+    else:
+        # return the base data if no attributes are requested
+        returned_stations = station_data_raw
+
+    returned_stations["stations"] = distance_calc(returned_stations["stations"],
+                                                  latitude, longitude)
+    # Run the distance sort
+    returned_stations["stations"] = sorted(
+        returned_stations["stations"], key=sort_function)
+
+    return returned_stations
+
+
+def search_inventory(inventory, latitude, longitude, startdate, enddate, attributes,
+                     bbox_max, save_partial, no_attributes, command, nearest):
+    """search_stations answered from the local station inventory"""
+    stations = inventory.nearest(
+        latitude, longitude, k=nearest, radius=bbox_max,
+        attributes=[] if no_attributes else attributes,
+        startdate=None if save_partial else startdate,
+        enddate=None if save_partial else enddate)
+
+    if len(stations) == 0:
+        logging.warning("No station of the inventory within %f km.", bbox_max)
+        raise SearchError("No station of the inventory within the maximum box length.")
+
+    logging.info("%i station(s) found in the inventory", len(stations))
+
+    return {"stations": stations, "metadata": {"command": command}}
+
+
+def station_parameters(station_id, dataset, startdate, enddate, data_types=None):
+    """parameters of the data API for one station
+
+    with data_types only those data types are sent, without their
+    attributes and the station location.  None asks for everything
+    """
+    parameters = {
+        'dataset': dataset,
+        'startDate': startdate, 'endDate': enddate,
+        'stations': station_id,
+        'format': 'json'
+    }
+    if data_types is not None:
+        parameters.update({'dataTypes': ','.join(data_types),
+                           'includeAttributes': 'false',
+                           'includeStationLocation': '0'})
 
-    return given_stations
+    return parameters
 
 
-returned_stations["stations"] = distance_calc(returned_stations["stations"])
-# Run the distance sort
-returned_stations["stations"] = sorted(
-    returned_stations["stations"], key=sort_function)
+def save_station_data(data, station_id, data_path):
+    """write the data of one station under data_path, one compact record per line"""
+    if not os.path.exists(data_path):
+        os.makedirs(data_path, exist_ok=True)
+    save_path = os.path.join(data_path, station_id + '.json')
+    write_json_array(data, save_path)
 
-stationNum = len(returned_stations["stations"])
 
-logging.info("returning %i station(s) in %s",
-             stationNum, SORTEDSTATIONSFILEPATH)
+def fetch_station_data(station_id, dataset, startdate, enddate, data_path=None,
+                       session=None, data_types=None):
+    """call the data API for one station, save it under data_path and return it
 
-# print the sorted and useful list
-with open(SORTEDSTATIONSFILEPATH, 'w') as sortedout:
-    print(json.dumps(returned_stations, indent=2), file=sortedout)
+    raises ValueError when the API answers with an error instead of records,
+    nothing is saved then
+    """
+    data_parameters = station_parameters(station_id, dataset, startdate, enddate, data_types)
 
-# call other API for actual data for all of the stations, each individually named
+    response = ncei_client.get(DATA_URL, data_parameters, session)
+    data = response.json()
+    if response.status_code != 200 or not isinstance(data, list):
+        raise ValueError("data API returned an error (status %i)" % response.status_code, data)
+    metrics.count("records_downloaded", len(data))
 
-for station in returned_stations["stations"]:
+    if data_path is not None:
+        save_station_data(data, station_id, data_path)
 
-    data_parameters = {
-        'dataset': DATASET,
-        'startDate': STARTDATE, 'endDate': ENDDATE,
-        'stations': station['station'],
-        'format': 'json'
-    }
+    return data
+
+
+# Long date ranges are requested as several smaller ranges at the same time
+def split_date_range(startdate, enddate, chunk_days):
+    """split startdate - enddate into ranges of at most chunk_days days"""
+    if chunk_days < 1:
+        raise ValueError("chunk_days must be at least 1, got %r" % (chunk_days,))
+    start = datetime.date.fromisoformat(startdate)
+    end = datetime.date.fromisoformat(enddate)
+
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + datetime.timedelta(days=chunk_days - 1), end)
+        chunks.append((start.isoformat(), chunk_end.isoformat()))
+        start = chunk_end + datetime.timedelta(days=1)
+
+    return chunks
 
-    response = requests.get(
-        "https://www.ncei.noaa.gov/access/services/data/v1", data_parameters)
 
-    if not os.path.exists(DATAFILEPATH):
-        os.makedirs(DATAFILEPATH)
-    save_path = DATAFILEPATH + station['station'] + '.json'
-    with open(save_path, 'w') as file_out:
-        print(json.dumps(response.json(), indent=2), file=file_out)
+def station_batches(station_ids, span_days, max_batch=MAX_BATCH,
+                    max_station_days=MAX_STATION_DAYS):
+    """group the stations for multi-station requests
+
+    a batch holds at most max_batch stations and max_station_days days of
+    data, the batches are balanced so the last one is not nearly empty
+    """
+    if len(station_ids) == 0:
+        return []
+
+    size = max(1, min(max_batch, max_station_days // max(1, span_days)))
+    count = math.ceil(len(station_ids) / size)
+    size = math.ceil(len(station_ids) / count)
+
+    return [station_ids[i:i + size] for i in range(0, len(station_ids), size)]
+
+
+def fetch_chunk(station_ids, dataset, chunk, session=None, retries=2, data_types=None,
+                stream_path=None, position=0):
+    """request one date range of a batch of stations, retrying it alone when it fails
+
+    returns the records of every station.  with stream_path the records are
+    streamed into the part files of the chunk under it instead, see
+    stream_chunk, and the number of records of every station is returned
+    """
+    for attempt in range(retries + 1):
+        try:
+            if stream_path is not None:
+                return stream_chunk(station_ids, dataset, chunk, position, stream_path,
+                                    session, data_types)
+            data = fetch_station_data(','.join(station_ids), dataset, chunk[0], chunk[1],
+                                      session=session, data_types=data_types)
+            return split_by_station(data, station_ids)
+        except (OSError, ValueError) as error:
+            if attempt == retries:
+                raise
+            logging.warning("Retrying station(s) %s for %s - %s: %s",
+                            ','.join(station_ids), chunk[0], chunk[1], error)
+
+
+def split_by_station(data, station_ids):
+    """split the records of a multi-station response on their STATION field"""
+    records = {station_id: [] for station_id in station_ids}
+    if len(station_ids) == 1:
+        records[station_ids[0]] = data
+        return records
+
+    for record in data:
+        station_records = records.get(record.get('STATION'))
+        if station_records is not None:
+            station_records.append(record)
+
+    return records
+
+
+def merge_records(chunks):
+    """merge the records of several date ranges into one ordered series"""
+    if len(chunks) == 1:
+        return chunks[0]
+
+    seen = set()
+    merged = []
+    for records in chunks:
+        for record in records:
+            key = (record.get('STATION'), record.get('DATE'))
+            if key not in seen:
+                seen.add(key)
+                merged.append(record)
+
+    merged.sort(key=lambda record: record.get('DATE', ''))
+
+    return merged
+
+
+def chunk_part_path(data_path, station_id, position):
+    """part file of the streamed records of one station for one chunk"""
+    return os.path.join(data_path, "%s.%i.part" % (station_id, position))
+
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def stream_chunk(station_ids, dataset, chunk, position, data_path, session=None,
+                 data_types=None):
+    """download one date range of a batch of stations record by record
+
+    the records are split on their STATION field as they arrive and written
+    to one part file per station, one JSON record per line.  returns the
+    number of records of every station
+    """
+    data_parameters = station_parameters(','.join(station_ids), dataset, chunk[0], chunk[1],
+                                         data_types)
+
+    if not os.path.exists(data_path):
+        os.makedirs(data_path, exist_ok=True)
+
+    counts = {station_id: 0 for station_id in station_ids}
+    part_files = {}
+    response = ncei_client.get(DATA_URL, data_parameters, session, stream=True)
+    try:
+        for record in iter_json_array(counted_chunks(response.iter_content(CHUNK_BYTES))):
+            station_id = station_ids[0] if len(station_ids) == 1 else record.get('STATION')
+            if station_id not in counts:
+                continue
+            if station_id not in part_files:
+                part_files[station_id] = open(
+                    chunk_part_path(data_path, station_id, position), 'w')
+            part_files[station_id].write(json.dumps(record) + "\n")
+            counts[station_id] += 1
+    except (OSError, ValueError):
+        # a retry starts over, nothing of this attempt may be left behind
+        for part_file in part_files.values():
+            part_file.close()
+        remove_files(part_file.name for part_file in part_files.values())
+        raise
+    finally:
+        response.close()
+        for part_file in part_files.values():
+            part_file.close()
+    metrics.count("records_downloaded", sum(counts.values()))
+
+    return counts
+
+
+def part_records(paths):
+    """the records of the part files one after the other"""
+    for path in paths:
+        # a station without records in a chunk has no part file
+        if not os.path.exists(path):
+            continue
+        with open(path) as file_in:
+            for line in file_in:
+                yield json.loads(line)
+
+
+def save_streamed_station(station_id, chunk_count, data_path):
+    """join the part files of a station into its JSON file record by record
+
+    the chunks do not overlap and are in date order, so joining them in
+    turn gives the same series as merge_records
+    """
+    paths = [chunk_part_path(data_path, station_id, position)
+             for position in range(chunk_count)]
+    save_path = os.path.join(data_path, station_id + '.json')
+    part_path = save_path + '.part'
+    try:
+        write_json_array(part_records(paths), part_path)
+    except (OSError, ValueError):
+        remove_files([part_path])
+        raise
+    finally:
+        remove_files(paths)
+    os.replace(part_path, save_path)
+
+
+class ChunkedDownload:
+    """the requests of a download split into date chunks and station batches
+
+    every chunk of every batch is one request, the answers are kept per
+    station until all of its chunks arrived.  shared by
+    fetch_stations_batched and the asyncio client
+    """
+
+    def __init__(self, station_ids, chunks, batch=False):
+        span_days = (datetime.date.fromisoformat(chunks[0][1]) -
+                     datetime.date.fromisoformat(chunks[0][0])).days + 1
+        if batch:
+            self.batches = station_batches(list(station_ids), span_days)
+        else:
+            self.batches = [[station_id] for station_id in station_ids]
+
+        self.chunks = chunks
+        self.results = {station_id: [None] * len(chunks) for station_id in station_ids}
+        self.remaining = {station_id: len(chunks) for station_id in station_ids}
+        self.failed = set()
+
+        logging.info("Requesting %i station(s) in %i request(s)",
+                     len(station_ids), len(self.batches) * len(chunks))
+
+    def requests(self):
+        """(station ids, position, chunk) of every request"""
+        return [(batch_ids, position, chunk)
+                for batch_ids in self.batches
+                for position, chunk in enumerate(self.chunks)]
+
+    def received(self, batch_ids, position, answer=None, error=None):
+        """record the answer of one request, or the error it failed with
+
+        returns (station id, chunks) of the stations this request completed,
+        chunks is None when the download of the station failed
+        """
+        if error is None:
+            for station_id, records in answer.items():
+                self.results[station_id][position] = records
+        else:
+            for station_id in batch_ids:
+                if station_id not in self.failed:
+                    logging.error("Download failed for station %s: %s", station_id, error)
+                self.failed.add(station_id)
+
+        completed = []
+        for station_id in batch_ids:
+            self.remaining[station_id] -= 1
+            if self.remaining[station_id] == 0:
+                station_chunks = self.results.pop(station_id)
+                if station_id in self.failed:
+                    station_chunks = None
+                completed.append((station_id, station_chunks))
+
+        return completed
+
+
+def fetch_stations_batched(station_ids, dataset, chunks, data_path, workers=8,
+                           session=None, on_fetched=None, retries=2, batch=False,
+                           data_types=None, stream=False):
+    """fetch_stations_data with date ranges split into chunks and stations in batches
+
+    every chunk of every batch is its own request in the pool, a station is
+    merged and saved once all of its chunks arrived.  with stream the
+    responses go to part files on disk and are joined from there
+    """
+    download = ChunkedDownload(station_ids, chunks, batch)
+
+    fetched = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(fetch_chunk, batch_ids, dataset, chunk,
+                                   session, retries, data_types,
+                                   data_path if stream else None, position): (batch_ids, position)
+                   for batch_ids, position, chunk in download.requests()}
+        for future in as_completed(futures):
+            batch_ids, position = futures[future]
+            try:
+                completed = download.received(batch_ids, position, future.result())
+            except (OSError, ValueError) as error:
+                completed = download.received(batch_ids, position, error=error)
+
+            for station_id, station_chunks in completed:
+                if station_chunks is None:
+                    if stream:
+                        remove_files(chunk_part_path(data_path, station_id, position)
+                                     for position in range(len(chunks)))
+                    continue
+                if stream:
+                    save_streamed_station(station_id, len(chunks), data_path)
+                else:
+                    save_station_data(merge_records(station_chunks), station_id, data_path)
+                fetched.append(station_id)
+                if on_fetched is not None:
+                    on_fetched(station_id)
+
+    return fetched
+
+
+def counted_chunks(chunks):
+    """pass the chunks of a streamed response through, counting their bytes"""
+    for chunk in chunks:
+        metrics.count("ncei_bytes", len(chunk), endpoint="data")
+        yield chunk
+
+
+def stream_station_data(station_id, dataset, startdate, enddate, data_path,
+                        session=None, data_types=None):
+    """download one station into data_path record by record
+
+    the response is never held in memory as a whole, which keeps long date
+    ranges cheap.  returns the number of records saved
+    """
+    data_parameters = station_parameters(station_id, dataset, startdate, enddate, data_types)
+
+    if not os.path.exists(data_path):
+        os.makedirs(data_path, exist_ok=True)
+    save_path = os.path.join(data_path, station_id + '.json')
+
+    # written next to the final file so an interrupted download never looks complete
+    part_path = save_path + '.part'
+
+    response = ncei_client.get(DATA_URL, data_parameters, session, stream=True)
+    try:
+        records = iter_json_array(counted_chunks(response.iter_content(CHUNK_BYTES)))
+        count = write_json_array(records, part_path)
+        metrics.count("records_downloaded", count)
+    except (OSError, ValueError):
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        response.close()
+    os.replace(part_path, save_path)
+
+    return count
+
+
+def fetch_stations_data(station_ids, dataset, startdate, enddate, data_path,
+                        workers=8, session=None, stream=False, on_fetched=None,
+                        chunk_days=None, batch=False, data_types=None):
+    """download several stations at once with at most `workers` requests in flight
+
+    every station is written under data_path as soon as it arrives, record
+    by record when stream is set, and on_fetched(station_id) is called once
+    it is saved.  date ranges longer than chunk_days are fetched as several
+    requests and merged, with batch several stations share one request.
+    data_types limits the download to those data types, see
+    station_parameters.  returns the list of the stations that were saved
+    """
+    if session is None:
+        session = ncei_client.get_session(workers)
+
+    chunks = [(startdate, enddate)]
+    if chunk_days is not None:
+        chunks = split_date_range(startdate, enddate, chunk_days)
+    if len(chunks) > 1 or (batch and len(station_ids) > 1):
+        return fetch_stations_batched(station_ids, dataset, chunks, data_path,
+                                      workers, session, on_fetched, batch=batch,
+                                      data_types=data_types, stream=stream)
+
+    fetch = stream_station_data if stream else fetch_station_data
+
+    fetched = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(fetch, station_id, dataset,
+                                   startdate, enddate, data_path, session,
+                                   data_types): station_id
+                   for station_id in station_ids}
+        for future in as_completed(futures):
+            station_id = futures[future]
+            try:
+                future.result()
+            except (OSError, ValueError) as error:
+                logging.error("Download failed for station %s: %s", station_id, error)
+                continue
+            fetched.append(station_id)
+            if on_fetched is not None:
+                on_fetched(station_id)
+
+    return fetched
+
+
+def positive_int(text):
+    """argparse type of the counts that must be at least 1"""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %i" % value)
+    return value
+
+
+def parse_arguments(argv=None):
+    """parse the command line arguments"""
+    # given test query parameters
+    parser = argparse.ArgumentParser(
+        description='Query the NCEI API with given arguments.')
+
+    group1 = parser.add_argument_group('Required', 'Required arguments')
+    group1.add_argument('-d', '--dataset', type=str, required=True,
+                        help='Dataset to search through.  Found in NCEI documentation or site.')
+    group1.add_argument('-la', '--latitude', type=float, required=True,
+                        help='Latitude of the source point')
+
+    group1.add_argument('-lo', '--longitude', type=float, required=True,
+                        help='Longitude of the source point')
+
+    group1.add_argument('-sd', '--startdate', type=str, required=True,
+                        help='startDate in YYYY-MM-DD format')
+
+    group1.add_argument('-ed', '--enddate', type=str, required=True,
+                        help="endDate in YYYY-MM-DD format")
+
+    group1.add_argument('-a', '--attributes', type=str, required=True,
+                        help='List of data types from NCEI.  1 minimum required',
+                        nargs='+')
+
+    group2 = parser.add_argument_group('Optional', 'Optional arguments')
+    help_string = "maximum length of the boundingbox in km.  defaults to 100."
+    group2.add_argument('-b', '--bboxsize', type=float,
+                        help=help_string, default=100)
+
+    group2.add_argument('-s', '--stationspath', type=str,
+                        default="data/stations_sorted.json",
+                        help='sorted stations path.  default: "data/stations_sorted.json"')
+
+    group2.add_argument('-dp', '--datapath', type=str,
+                        default="data/stations/",
+                        help='path for the actual data.  default: "data/stations/"')
+
+    group2.add_argument('-dmp', '--dumpraw', action='store_true',
+                        default=False,
+                        help='Dump the raw search and error results and to the dump path under name search.json/error.json respectively')
+
+    group2.add_argument('-dmppath', '--dumppath', type=str,
+                        default="data/raw/",
+                        help='path for the raw search data.  default: "data/raw/"')
+
+    group2.add_argument('-i', '--includeincomplete', action='store_true',
+                        help='Store stations with attributes present, but for dates outside the request')
+    group2.add_argument('-na', '--noattributes',  action='store_true',
+                        help="when set it will search for attributes and will return the first applicable station.  Useful for finding attributes in a dataset.")
+    group2.add_argument('-c', '--cachepath', type=str, default=None,
+                        help='path of the search cache database.  no cache when not set')
+    group2.add_argument('-ct', '--cachettl', type=float, default=DEFAULT_TTL / 3600,
+                        help='hours a cached search stays valid.  default: 168')
+    group2.add_argument('-inv', '--inventory', type=str, default=None,
+                        help='path of ghcnd-inventory.txt, search the stations in it instead of the API')
+    group2.add_argument('-k', '--nearest', type=int, default=10,
+                        help='number of stations returned from the inventory.  default: 10')
+    group2.add_argument('-st', '--stream', action='store_true',
+                        help='write the station data to disk while it downloads instead of loading it whole')
+    group2.add_argument('-cd', '--chunkdays', type=positive_int, default=None,
+                        help='request date ranges longer than this many days in chunks.  no chunks when not set')
+    group2.add_argument('-bt', '--batch', action='store_true',
+                        help='request the data of several stations together')
+    group2.add_argument('-ad', '--alldatatypes', action='store_true',
+                        help='download every data type with its attributes and the '
+                             'station location, not only the attributes searched for')
+    group2.add_argument('-r', '--rate', type=float, default=ncei_client.DEFAULT_RATE,
+                        help='maximum number of requests per second.  default: 5')
+    group2.add_argument('-db', '--doubling', action='store_true',
+                        help='request every box size in turn instead of the largest box once')
+    group2.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of stations downloaded at the same time.  default: 8')
+    group2.add_argument('-m', '--metricspath', type=str, default=None,
+                        help='write the request, cache and timing metrics as JSON to this path')
+    group2.add_argument('-pm', '--prometheuspath', type=str, default=None,
+                        help='also write the metrics in the Prometheus text format to this path')
+    group2.add_argument('-pf', '--profiledir', type=str, default=None,
+                        help='write a cProfile file of the search and of the download to this folder')
+
+    return parser.parse_args(argv)
+
+
+def main():
+    """command line entry point"""
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    args = parse_arguments()
+
+    ncei_client.set_rate(args.rate)
+    metrics.set_profiling(metrics.default_profile_dir(args.profiledir))
+
+    cache = None
+    if args.cachepath is not None:
+        cache = SearchCache(args.cachepath, ttl=args.cachettl * 3600)
+
+    inventory = None
+    if args.inventory is not None:
+        inventory = StationInventory.load(args.inventory, args.attributes)
+
+    try:
+        with metrics.stage("search"):
+            returned_stations = search_stations(
+                args.latitude, args.longitude, args.startdate, args.enddate,
+                args.attributes, bbox_max=args.bboxsize, dataset=args.dataset,
+                save_partial=args.includeincomplete, no_attributes=args.noattributes,
+                dump_path=args.dumppath if args.dumpraw else None,
+                command=' '.join(sys.argv[0:]), cache=cache,
+                inventory=inventory, nearest=args.nearest, doubling=args.doubling)
+    except SearchError:
+        sys.exit()
+
+    station_num = len(returned_stations["stations"])
+
+    logging.info("returning %i station(s) in %s",
+                 station_num, args.stationspath)
+
+    # print the sorted and useful list
+    with open(args.stationspath, 'w') as sortedout:
+        print(json.dumps(returned_stations, indent=2), file=sortedout)
+
+    # call other API for actual data for all of the stations, each individually named
+    station_ids = [station['station'] for station in returned_stations["stations"]]
+    with metrics.stage("download"):
+        fetch_stations_data(station_ids, args.dataset, args.startdate, args.enddate,
+                            args.datapath, workers=args.workers, stream=args.stream,
+                            chunk_days=args.chunkdays, batch=args.batch,
+                            data_types=None if args.alldatatypes else args.attributes)
+
+    if args.metricspath is not None:
+        metrics.get_metrics().write(args.metricspath, args.prometheuspath)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""search_cache module keeps the results of the NCEI search API on disk
+
+Entries are keyed by dataset, date range and bounding box.  A search whose
+bounding box lies inside a cached one is answered by filtering the cached
+stations on their coordinates, so neighbouring points rarely need a request.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+DEFAULT_TTL = 7 * 24 * 3600  # seconds
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class SearchCache:
+    """sqlite backed cache of search results"""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS search ("
+                "id INTEGER PRIMARY KEY, dataset TEXT, start_date TEXT, end_date TEXT, "
+                "north REAL, west REAL, south REAL, east REAL, "
+                "created REAL, last_used REAL, size INTEGER, payload TEXT)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS search_key ON search (dataset, start_date, end_date)")
+
+    def get(self, dataset, start_date, end_date, bounds):
+        """return the cached stations inside bounds, None on a miss
+
+        bounds is (north, west, south, east)
+        """
+        north, west, south, east = bounds
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT id, payload FROM search "
+                "WHERE dataset = ? AND start_date = ? AND end_date = ? "
+                "AND north >= ? AND west <= ? AND south <= ? AND east >= ? AND created >= ? "
+                "ORDER BY (north - south) * (east - west) LIMIT 1",
+                (dataset, start_date, end_date, north, west, south, east,
+                 now - self.ttl)).fetchone()
+            if row is None:
+                metrics.count("search_cache_lookups", result="miss")
+                return None
+            self.connection.execute(
+                "UPDATE search SET last_used = ? WHERE id = ?", (now, row[0]))
+
+        metrics.count("search_cache_lookups", result="hit")
+        stations = json.loads(row[1])
+
+        return [station for station in stations
+                if south <= station['latitude'] <= north
+                and west <= station['longitude'] <= east]
+
+    def put(self, dataset, start_date, end_date, bounds, stations):
+        """store the stations returned for bounds"""
+        north, west, south, east = bounds
+        payload = json.dumps(stations)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO search (dataset, start_date, end_date, north, west, south, east, "
+                "created, last_used, size, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (dataset, start_date, end_date, north, west, south, east,
+                 now, now, len(payload), payload))
+            self.evict(now)
+
+    def evict(self, now):
+        """drop expired entries, then the least recently used ones above max_bytes"""
+        self.connection.execute("DELETE FROM search WHERE created < ?", (now - self.ttl,))
+
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM search").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self.connection.execute(
+            "SELECT id, size FROM search ORDER BY last_used").fetchall()
+        evicted = []
+        for entry_id, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((entry_id,))
+            total -= size
+        self.connection.executemany("DELETE FROM search WHERE id = ?", evicted)
+        logging.info("Evicted %i search cache entries", len(evicted))
+
+    def close(self):
+        """close the database"""
+        with self.lock:
+            self.connection.close()
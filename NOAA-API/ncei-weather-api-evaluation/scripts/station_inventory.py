@@ -0,0 +1,141 @@
+"""station_inventory module finds stations locally from the GHCND inventory file
+
+The inventory (ghcnd-inventory.txt from
+https://www.ncei.noaa.gov/pub/data/ghcn/daily/) lists every station with its
+coordinates and the years covered by each data type.  The stations are held
+as unit sphere coordinates in a k-d tree (scipy, when installed) so the
+nearest stations of a point are found without calling the search API.
+"""
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional, fall back to a vectorized scan
+    cKDTree = None
+
+RADIUS = 6371.0
+DEFAULT_ELEMENTS = ("TMIN", "TMAX", "PRCP")
+
+
+def to_unit_sphere(latitudes, longitudes):
+    """convert degrees to xyz coordinates on the unit sphere"""
+    rad_lat = np.radians(latitudes)
+    rad_long = np.radians(longitudes)
+    return np.column_stack((np.cos(rad_lat) * np.cos(rad_long),
+                            np.cos(rad_lat) * np.sin(rad_long),
+                            np.sin(rad_lat)))
+
+
+def haversine(latitude, longitude, latitudes, longitudes):
+    """distance in km from one point to arrays of points"""
+    rad_lat = np.radians(latitude)
+    station_lat = np.radians(latitudes)
+    distance_lat = rad_lat - station_lat
+    distance_long = np.radians(longitude) - np.radians(longitudes)
+    calc1 = np.sin(distance_lat / 2)**2 + np.cos(station_lat) * \
+        np.cos(rad_lat) * np.sin(distance_long / 2)**2
+    calc2 = 2 * np.arctan2(np.sqrt(calc1), np.sqrt(1 - calc1))
+    return RADIUS * calc2
+
+
+class StationInventory:
+    """stations of the inventory file with a spatial index"""
+
+    def __init__(self, station_ids, latitudes, longitudes, coverage):
+        # coverage maps every element to (first_year, last_year) arrays,
+        # -1 where the station does not have the element
+        self.station_ids = np.asarray(station_ids)
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.coverage = coverage
+
+        self.points = to_unit_sphere(self.latitudes, self.longitudes)
+        self.tree = cKDTree(self.points) if cKDTree is not None else None
+
+    @classmethod
+    def load(cls, path, elements=DEFAULT_ELEMENTS):
+        """read ghcnd-inventory.txt keeping only the given elements"""
+        elements = tuple(elements)
+        wanted = set(elements)
+        index = {}
+        latitudes = []
+        longitudes = []
+        rows = []
+
+        with open(path) as fin:
+            for line in fin:
+                fields = line.split()
+                if len(fields) < 6 or fields[3] not in wanted:
+                    continue
+                station_id = fields[0]
+                if station_id not in index:
+                    index[station_id] = len(index)
+                    latitudes.append(float(fields[1]))
+                    longitudes.append(float(fields[2]))
+                rows.append((index[station_id], fields[3], int(fields[4]), int(fields[5])))
+
+        coverage = {}
+        for element in elements:
+            coverage[element] = (np.full(len(index), -1, dtype=np.int16),
+                                 np.full(len(index), -1, dtype=np.int16))
+        for position, element, first_year, last_year in rows:
+            coverage[element][0][position] = first_year
+            coverage[element][1][position] = last_year
+
+        return cls(list(index), latitudes, longitudes, coverage)
+
+    def within(self, latitude, longitude, radius):
+        """indices of the stations closer than radius km"""
+        chord = 2 * np.sin(min(radius / RADIUS, np.pi) / 2)
+        point = to_unit_sphere([latitude], [longitude])[0]
+
+        if self.tree is not None:
+            return np.asarray(self.tree.query_ball_point(point, chord), dtype=int)
+
+        squared = ((self.points - point)**2).sum(axis=1)
+        return np.nonzero(squared <= chord**2)[0]
+
+    def eligible(self, candidates, attributes, startdate=None, enddate=None):
+        """mask of the candidates having every attribute for the date range"""
+        mask = np.ones(len(candidates), dtype=bool)
+        for attribute in attributes:
+            if attribute not in self.coverage:
+                raise ValueError("Inventory was not loaded with element " + attribute)
+            first_year, last_year = self.coverage[attribute]
+            mask &= first_year[candidates] >= 0
+            if startdate is not None:
+                mask &= first_year[candidates] <= int(startdate[:4])
+            if enddate is not None:
+                mask &= last_year[candidates] >= int(enddate[:4])
+        return mask
+
+    def nearest(self, latitude, longitude, k=10, radius=100, attributes=DEFAULT_ELEMENTS,
+                startdate=None, enddate=None):
+        """k nearest stations within radius km having the attributes for the dates
+
+        returns station entries in the format of search_api, sorted by distance
+        """
+        candidates = self.within(latitude, longitude, radius)
+        candidates = candidates[self.eligible(candidates, attributes, startdate, enddate)]
+
+        distances = haversine(latitude, longitude, self.latitudes[candidates],
+                              self.longitudes[candidates])
+        order = np.argsort(distances, kind="stable")[:k]
+
+        stations = []
+        for position, distance in zip(candidates[order], distances[order]):
+            data_types = []
+            for element, (first_year, last_year) in self.coverage.items():
+                if first_year[position] < 0:
+                    continue
+                data_types.append(
+                    {'id': element,
+                     'dateRange': {'start': str(first_year[position]) + "-01-01T00:00:00",
+                                   'end': str(last_year[position]) + "-12-31T23:59:59"}})
+            stations.append({"station": str(self.station_ids[position]),
+                             "dataTypes": data_types,
+                             'latitude': float(self.latitudes[position]),
+                             'longitude': float(self.longitudes[position]),
+                             'distance': float(distance)})
+
+        return stations
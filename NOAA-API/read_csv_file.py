@@ -1,25 +1,117 @@
-import math
+import numpy as np
 import pandas as pd
 import os
+import sys
 import json
+import logging
+import threading
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "ncei-weather-api-evaluation", "scripts"))
+import search_api  # noqa: E402
+import ncei_client  # noqa: E402
+import ncei_async  # noqa: E402
+import metrics  # noqa: E402
+from search_cache import SearchCache  # noqa: E402
+from station_inventory import StationInventory  # noqa: E402
+from json_stream import iter_json_file, batched  # noqa: E402
 
 
 class MakeDirectory:
 
-    def make_directory(self):
-        os.mkdir("output")
-
-        os.chdir(r"output/")
+    def __init__(self, output_root="output"):
+        self.output_root = output_root
 
-        os.mkdir(r"NOAA-data-coverage")
-        os.mkdir(r"NOAA-data-csv")
-        os.mkdir(r"NOAA-data-csv-sorted")
-        os.mkdir(r"NOAA-data-JSON")
-        os.mkdir(r"NOAA-data-missing-date")
-        os.mkdir(r"NOAA-data-station-info")
-        os.mkdir(r"NOAA-data-valid-station-report")
-
-        os.chdir(r"../")
+    # existing folders are kept so an interrupted run can continue
+    def make_directory(self):
+        for folder in ["NOAA-data-coverage", "NOAA-data-csv", "NOAA-data-csv-sorted",
+                       "NOAA-data-JSON", "NOAA-data-missing-date",
+                       "NOAA-data-station-info", "NOAA-data-valid-station-report"]:
+            os.makedirs(os.path.join(self.output_root, folder), exist_ok=True)
+
+
+class RunManifest:
+
+    # journal of the finished work of a run, one JSON line per finished input
+    # point, station download or stage. a re-run with the same parameters
+    # skips everything recorded in it
+
+    # stages made from the searched points and downloaded stations, they are
+    # done again when a re-run adds a point or a station
+    DERIVED_STAGES = ("station_report", "json_to_csv", "data_coverage", "merge")
+
+    def __init__(self, parameters, path="output/run_manifest.jsonl"):
+        self.parameters = parameters
+        self.path = path
+        self.points = {}  # input file -> its stations
+        self.stations = set()
+        self.stages = set()
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self.load()
+        else:
+            self.record({"kind": "parameters", "parameters": parameters})
+
+    def load(self):
+        entries = []
+        with open(self.path) as fin:
+            for line in fin:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # last line cut by the interruption
+
+        if not entries or entries[0].get("parameters") != self.parameters:
+            raise ValueError(self.path + " belongs to a run with other parameters, "
+                             "remove the output folder to start a new run")
+
+        for entry in entries[1:]:
+            if entry["kind"] == "point":
+                self.points[entry["filename"]] = entry["stations"]
+            elif entry["kind"] == "station":
+                self.stations.add(entry["station"])
+            elif entry["kind"] == "stage":
+                self.stages.add(entry["stage"])
+            elif entry["kind"] == "reopen":
+                self.stages.difference_update(entry["stages"])
+
+        # rewrite the journal without a cut line
+        with open(self.path, 'w') as fout:
+            for entry in entries:
+                print(json.dumps(entry), file=fout)
+
+        logging.info("Continuing run: %i input point(s), %i station(s) and %i stage(s) done",
+                     len(self.points), len(self.stations), len(self.stages))
+
+    def record(self, entry):
+        with self.lock:
+            with open(self.path, 'a') as fout:
+                print(json.dumps(entry), file=fout)
+
+    def mark_point(self, filename, stations):
+        self.points[filename] = stations
+        self.record({"kind": "point", "filename": filename, "stations": stations})
+        self.reopen_stages()
+
+    def mark_station(self, station):
+        self.stations.add(station)
+        self.record({"kind": "station", "station": station})
+        self.reopen_stages()
+
+    # the stages done before a new point or station are stale
+    def reopen_stages(self, stages=DERIVED_STAGES):
+        stale = [stage for stage in stages if stage in self.stages]
+        if stale:
+            self.stages.difference_update(stale)
+            self.record({"kind": "reopen", "stages": stale})
+
+    def mark_stage(self, stage):
+        self.stages.add(stage)
+        self.record({"kind": "stage", "stage": stage})
 
 
 class ReadCsvFile:
@@ -33,45 +125,252 @@ class ReadCsvFile:
 
         return df
 
+    # the input a few rows at a time, for input files too large to hold at once
+    def read_chunks(self, chunk_size):
+        for df in pd.read_csv(self.csv_file, chunksize=chunk_size):
+            # coordinates stay floats when a chunk only holds round numbers
+            df[df.columns[1:3]] = df[df.columns[1:3]].astype(float)
+            yield df
+
+
+class StationStore:
+
+    # one canonical copy of every station table. "csv" keeps the plain csv
+    # files, "npz" stores typed numpy columns that load without parsing and
+    # the per input file folders only get a manifest of their stations
+    def __init__(self, storage="csv", output_root="output"):
+        if storage not in ("csv", "npz"):
+            raise ValueError("storage must be csv or npz, not " + str(storage))
 
-class CommandLine:
+        self.storage = storage
 
-    def __init__(self, df, box_range, start, end, data_type):
+        if storage == "csv":
+            self.path = os.path.join(output_root, "NOAA-data-csv")
+        else:
+            self.path = os.path.join(output_root, "NOAA-data-columnar")
+            os.makedirs(self.path, exist_ok=True)
+
+    def station_path(self, station_id):
+        return os.path.join(self.path, station_id + "." + self.storage)
+
+    def write(self, station_id, df):
+        if self.storage == "csv":
+            df.to_csv(self.station_path(station_id))
+            return
+
+        columns = {name: df[name].to_numpy(dtype=float) for name in df.columns if name != "date"}
+        np.savez(self.station_path(station_id),
+                 date=df["date"].to_numpy(dtype="datetime64[D]"), **columns)
+
+    def read(self, station_id):
+        if self.storage == "csv":
+            return pd.read_csv(self.station_path(station_id))
+
+        with np.load(self.station_path(station_id)) as archive:
+            df = pd.DataFrame({name: archive[name] for name in archive.files if name != "date"})
+            df.insert(0, "date", np.datetime_as_string(archive["date"], unit="D"))
+
+        return df
+
+    # per input file view of the stations, a copy of the csv files or a manifest
+    def write_view(self, folder, station_tables):
+        os.makedirs(folder, exist_ok=True)
+
+        if self.storage == "csv":
+            for station_id, df in station_tables.items():
+                df.to_csv(os.path.join(folder, station_id + ".csv"))
+            return
+
+        manifest = {"storage": self.storage,
+                    "stations": {station_id: os.path.relpath(self.station_path(station_id), folder)
+                                 for station_id in station_tables}}
+        with open(os.path.join(folder, "manifest.json"), 'w') as fout:
+            print(json.dumps(manifest, indent=2), file=fout)
+
+
+class StationSearch:
+
+    def __init__(self, df, box_range, start, end, data_type, workers=8, cache=None,
+                 inventory=None, nearest=10, stream=False, manifest=None, chunk_days=None,
+                 batch=False, output_root="output", asynchronous=False, all_data_types=False):
         self.df = df
         self.box_range = box_range
         self.start = start
         self.end = end
         self.data_type = data_type
-
-    def create_command(self, station_id, latitude, longitude):
+        self.workers = workers
+        self.cache = cache
+        self.inventory = inventory
+        self.nearest = nearest
+        self.stream = stream
+        self.manifest = manifest
+        self.chunk_days = chunk_days
+        self.batch = batch
+        self.output_root = output_root
+        self.asynchronous = asynchronous  # download on one asyncio event loop
+        self.all_data_types = all_data_types  # download what NCEI has, not only data_type
+
+    def search_point(self, station_id, latitude, longitude):
         filename = station_id + "_" + str(latitude) + "_" + str(longitude) + ".json"
 
-        output_path_1 = "../../output/NOAA-data-station-info"
-        output_path_2 = "../../output/NOAA-data-JSON/"
-
-        command = "python search_api.py -d daily-summaries -sd " + self.start + " -ed " + self.end + " -la " + \
-                  str(latitude) + " -lo " + str(longitude) + " -a " + self.data_type + " -b " + str(self.box_range) + " -s " + \
-                  output_path_1 + "/" + filename + " -dp " + output_path_2 + " -i"
-
-        return command
-
-    def operate_command(self):
-        os.chdir(r"ncei-weather-api-evaluation/scripts")
+        if self.manifest is not None and filename in self.manifest.points:
+            return self.manifest.points[filename]
+
+        output_path = os.path.join(self.output_root, "NOAA-data-station-info")
+
+        try:
+            returned_stations = search_api.search_stations(
+                latitude, longitude, self.start, self.end, self.data_type.split(),
+                bbox_max=self.box_range, dataset="daily-summaries", save_partial=True,
+                cache=self.cache, inventory=self.inventory, nearest=self.nearest)
+        except (search_api.SearchAPIError, OSError, ValueError) as error:
+            # not recorded in the manifest, the next run tries this point again
+            logging.error("Search failed for %s: %s", filename, error)
+            return []
+        except search_api.SearchError:
+            # no station inside box_range, the point is done
+            returned_stations = None
+        else:
+            with open(os.path.join(output_path, filename), 'w') as sortedout:
+                print(json.dumps(returned_stations, indent=2), file=sortedout)
+
+        stations = []
+        if returned_stations is not None:
+            stations = [station['station'] for station in returned_stations["stations"]]
+
+        if self.manifest is not None:
+            self.manifest.mark_point(filename, stations)
+
+        return stations
+
+    # search every input point first, then download each station only once
+    # returns the input points using every station
+    def operate_search(self):
+        station_points = self.search_points()
+        self.download_stations(station_points, len(self.df))
+
+        return station_points
+
+    # returns the input points using every station
+    def search_points(self):
         dataframe_list = self.df.values.tolist()
 
-        for i in range(len(dataframe_list)):
-            station_id = dataframe_list[i][0]
-            latitude = dataframe_list[i][1]
-            longitude = dataframe_list[i][2]
-
-            command_script = self.create_command(station_id, latitude, longitude)
-            os.system(command_script)
-
-        os.chdir(r"../..")
+        station_points = {}
+        with metrics.stage("search"):
+            for i in range(len(dataframe_list)):
+                station_id = dataframe_list[i][0]
+                latitude = dataframe_list[i][1]
+                longitude = dataframe_list[i][2]
+
+                for NOAA_station in self.search_point(station_id, latitude, longitude):
+                    station_points.setdefault(NOAA_station, []).append(station_id)
+                metrics.count("input_points_searched")
+
+        return station_points
+
+    # returns the stations downloaded by this call
+    def download_stations(self, station_points, point_count):
+        station_ids = list(station_points)
+        on_fetched = None
+        if self.manifest is not None:
+            station_ids = [x for x in station_ids if x not in self.manifest.stations]
+            on_fetched = self.manifest.mark_station
+
+        logging.info("Downloading %i unique station(s) for %i input point(s)",
+                     len(station_ids), point_count)
+
+        # only the data types of the report, without attributes and locations
+        data_types = None if self.all_data_types else self.data_type.split()
+
+        with metrics.stage("download"):
+            if self.asynchronous:
+                # workers is the number of requests in flight, there is no streaming
+                if self.stream:
+                    logging.warning("The asyncio download does not stream, "
+                                    "the responses are held in memory")
+                return ncei_async.fetch_stations_data(
+                    station_ids, "daily-summaries", self.start, self.end,
+                    os.path.join(self.output_root, "NOAA-data-JSON"), concurrency=self.workers,
+                    on_fetched=on_fetched, chunk_days=self.chunk_days, batch=self.batch,
+                    data_types=data_types)
+
+            return search_api.fetch_stations_data(
+                station_ids, "daily-summaries", self.start, self.end,
+                os.path.join(self.output_root, "NOAA-data-JSON"), workers=self.workers,
+                stream=self.stream, on_fetched=on_fetched, chunk_days=self.chunk_days,
+                batch=self.batch, data_types=data_types)
+
+
+class StationAssignments:
+
+    # long table of the stations kept for every input file, one row per input
+    # file and station in rank order. an input file without a valid station
+    # keeps one row without station so it is still listed
+    FILE = os.path.join("NOAA-data-valid-station-report", "NOAA_station_assignments.csv")
+    COLUMNS = ["filename", "station_ID", "rank", "distance(km)", "latitude", "longitude"]
+
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+
+        # input files in table order, input file -> row positions and
+        # station -> input files using it
+        self.filenames = self.df["filename"].unique().tolist()
+        valid = self.df[self.df["station_ID"].notna()]
+        valid_filenames = valid["filename"].to_numpy()
+        self.point_rows = {filename: valid.index[positions].tolist() for filename, positions
+                           in valid.groupby("filename", sort=False).indices.items()}
+        self.station_points = {station: valid_filenames[positions].tolist()
+                               for station, positions
+                               in valid.groupby("station_ID", sort=False).indices.items()}
+
+        self.records = self.df[["station_ID", "distance(km)", "latitude",
+                                "longitude"]].values.tolist()
+
+    # rows of StationReport.station_boolean:
+    # filename, number of stations, then station, distance, latitude, longitude
+    @classmethod
+    def from_report_rows(cls, report_rows):
+        rows = []
+        for report_row in report_rows:
+            filename = report_row[0]
+            valid_station_num = report_row[1]
+            if valid_station_num == 0:
+                rows.append([filename, None, 0, np.nan, np.nan, np.nan])
+            for j in range(valid_station_num):
+                station = report_row[2 + j * 4: 6 + j * 4]
+                rows.append([filename, station[0], j + 1] + station[1:])
+
+        return cls(pd.DataFrame(rows, columns=cls.COLUMNS))
+
+    @classmethod
+    def read(cls, output_root="output"):
+        # exact floats, the same values as a table handed over in memory
+        return cls(pd.read_csv(os.path.join(output_root, cls.FILE),
+                               float_precision="round_trip"))
+
+    def write(self, output_root="output"):
+        self.df.to_csv(os.path.join(output_root, self.FILE), index=False)
+
+    def points(self):
+        return self.filenames
+
+    def stations_for(self, filename):
+        return [self.records[position][0] for position in self.point_rows.get(filename, [])]
+
+    def points_for(self, station):
+        return self.station_points.get(station, [])
+
+    # [station, distance, latitude, longitude] of every station of the input file
+    def station_rows(self, filename):
+        return [list(self.records[position]) for position in self.point_rows.get(filename, [])]
 
 
 class StationReport:
 
+    def __init__(self, output_root="output", workers=4):
+        self.output_root = output_root
+        self.workers = workers  # station info files read at the same time
+
     def station_boolean(self, data, filename):
         list_whole = [filename]
 
@@ -106,29 +405,49 @@ class StationReport:
 
         return list_whole
 
-    def generate_report(self):
-        os.chdir(r"output/NOAA-data-station-info")
-        path = r"../../output/NOAA-data-station-info"
+    def read_station_info(self, json_file):
+        with open(os.path.join(self.output_root, "NOAA-data-station-info", json_file)) as f:
+            data = json.load(f)
+        metrics.count("input_points_reported")
+
+        return self.station_boolean(data, json_file)
+
+    # wide report and long assignment table of the searched input files
+    def build_report(self):
+        json_files = os.listdir(os.path.join(self.output_root, "NOAA-data-station-info"))
 
         list_whole = []
 
         max_length = 0
 
-        count = 0
-        for json_file in os.listdir(path):
-            f = open(json_file)
-            data = json.load(f)
-            each_row = self.station_boolean(data, json_file)
-            list_whole.append(each_row)
-            count += 1
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            for each_row in executor.map(self.read_station_info, json_files):
+                list_whole.append(each_row)
 
-            list_length = each_row[1]
+                list_length = each_row[1]
 
-            if list_length >= max_length:
-                max_length = list_length
+                if list_length >= max_length:
+                    max_length = list_length
 
         df = pd.DataFrame(list_whole)
 
+        df.columns = self.report_columns(max_length)
+
+        return df, StationAssignments.from_report_rows(list_whole)
+
+    def generate_report(self):
+        df, assignments = self.build_report()
+
+        df.to_csv(os.path.join(self.output_root, "NOAA-data-valid-station-report",
+                               "NOAA_valid_station_report.csv"))
+
+        # the stages after this one read the long table, not the wide report
+        assignments.write(self.output_root)
+
+        return assignments
+
+    # header of a report holding at most max_length stations per input file
+    def report_columns(self, max_length):
         column_base = ["filename", "valid_station_num"]
 
         for i in range(1, max_length + 1):
@@ -137,310 +456,716 @@ class StationReport:
             column_base.append("latitude")
             column_base.append("longitude")
 
-        df.columns = column_base
-
-        os.chdir(r"../../output/NOAA-data-valid-station-report")
-
-        df.to_csv("NOAA_valid_station_report.csv")
-
-        os.chdir(r"../../")
+        return column_base
 
 
 class JsonToCsv:
 
+    # csv column of the GHCND data types, other data types keep their id
+    COLUMN_NAMES = {'TMIN': 'min', 'TMAX': 'max', 'PRCP': 'precipitation'}
+
+    # data types converted to fahrenheit and to inches, others are kept as they come.
+    # GHCND gives the depths in tenths of mm, except snow and snow depth in whole mm
+    TEMPERATURE_TYPES = {'TMIN', 'TMAX', 'TAVG', 'TOBS', 'MNPN', 'MXPN'}
+    DEPTH_TYPES = {'PRCP', 'WESD', 'WESF', 'MDPR', 'EVAP'}
+    MM_DEPTH_TYPES = {'SNOW', 'SNWD'}
+
+    def __init__(self, data_types=("TMIN", "TMAX", "PRCP"), store=None, stream=False,
+                 json_path=None, assignments=None, write=True, output_root="output",
+                 workers=4):
+        self.data_types = list(data_types)
+        self.output_root = output_root
+        # folder of the downloaded station files
+        self.json_path = json_path if json_path is not None else \
+            os.path.join(output_root, "NOAA-data-JSON")
+        self.store = store if store is not None else StationStore(output_root=output_root)
+        self.workers = workers  # stations converted at the same time
+        self.stream = stream  # read the JSON files a chunk of records at a time
+        self.assignments = assignments  # read from disk when not given
+        self.write = write  # False keeps the tables in memory until write_outputs
+        self.station_files = {}  # station id -> JSON file
+        self.station_tables = {}  # station id -> converted table
+        self.views = {}  # input file (without .json) -> its stations with data
+
+    # both conversions work on single values and on whole numpy arrays
     def temp_conversion(self, temp):
         return temp / 10 * (9 / 5) + 32
 
     def prcp_coversion(self, prcp):
         return prcp * 0.0393701
 
+    # input file (without .json) -> its stations, in the order of the report
     def CRO_NOAA_dictionary(self):
-        os.chdir(r"output/NOAA-data-valid-station-report")
-
-        df = pd.read_csv("NOAA_valid_station_report.csv")
+        assignments = self.assignments
+        if assignments is None:
+            assignments = StationAssignments.read(self.output_root)
 
-        num_row = df.shape[0]
+        return {filename[:-5]: assignments.stations_for(filename)
+                for filename in assignments.points()}
 
-        list_CRO = []
-        list_NOAA_station = []
-        for i in range(num_row):
-            list_CRO.append(df['filename'][i][:-5])
-            valid_station_num = df['valid_station_num'][i]
+    # build the table column by column, missing values become NaN
+    def convert_to_csv(self, data):
+        records = pd.DataFrame.from_records(data, columns=["DATE"] + self.data_types)
 
-            list_NOAA_sub = []
-            for j in range(1, int(valid_station_num) + 1):
-                index = 4 * j - 1
-                list_NOAA_sub.append(df.iloc[i, index])
-            list_NOAA_station.append(list_NOAA_sub)
+        df = pd.DataFrame({"date": records["DATE"]})
 
-        return dict(zip(list_CRO, list_NOAA_station)), df
+        for data_type in self.data_types:
+            values = pd.to_numeric(records[data_type], errors="coerce").to_numpy(dtype=float)
 
-    def convert_to_csv(self, data):
+            if data_type in self.TEMPERATURE_TYPES:
+                values = self.temp_conversion(values)
+            elif data_type in self.DEPTH_TYPES:
+                values = self.prcp_coversion(values)
+            elif data_type in self.MM_DEPTH_TYPES:
+                # to tenths of mm first, so snow has the scale of the precipitation
+                values = self.prcp_coversion(values * 10)
 
-        list_whole = []
+            df[self.COLUMN_NAMES.get(data_type, data_type)] = values
 
-        for i in range(len(data)):
-            list_row = [data[i]['DATE']]
+        return df
 
-            if data[i].get('TMIN') is None:
-                list_row.append(None)
+    # list the JSON folder once, station id -> file
+    def index_station_files(self, path):
+        self.station_files = {}
+        for json_file in os.listdir(path):
+            if json_file.endswith(".json"):
+                self.station_files[json_file[:-5]] = os.path.join(path, json_file)
+
+        return self.station_files
+
+    # convert every station only once, stations shared by several input
+    # files come from the cache. returns None when there is no data file
+    def station_table(self, NOAA_station):
+        if NOAA_station not in self.station_tables:
+            json_path = self.station_files.get(NOAA_station)
+            if json_path is None:
+                return None
+
+            if self.stream:
+                chunks = [self.convert_to_csv(data) for data in batched(iter_json_file(json_path))]
+                df = pd.concat(chunks, ignore_index=True) if chunks else self.convert_to_csv([])
             else:
-                list_row.append(self.temp_conversion(int(data[i]['TMIN'])))
+                with open(json_path) as f:
+                    data = json.load(f)
 
-            if data[i].get('TMAX') is None:
-                list_row.append(None)
-            else:
-                list_row.append(self.temp_conversion(int(data[i]['TMAX'])))
+                df = self.convert_to_csv(data)
+            if self.write:
+                self.store.write(NOAA_station, df)
+            metrics.count("stations_converted")
+            metrics.count("records_converted", len(df))
 
-            if data[i].get('PRCP') is None:
-                list_row.append(None)
-            else:
-                list_row.append(self.prcp_coversion(int(data[i]['PRCP'])))
+            self.station_tables[NOAA_station] = df
 
-            list_whole.append(list_row)
+        return self.station_tables[NOAA_station]
 
-        df = pd.DataFrame(list_whole)
-        df.columns = ["date", "min", "max", "precipitation"]
-
-        return df
+    def write_view(self, CRO_id, station_tables):
+        self.store.write_view(os.path.join(self.output_root, "NOAA-data-csv-sorted", CRO_id),
+                              station_tables)
 
     def generate_report(self):
-        dict, df = self.CRO_NOAA_dictionary()
-
-        os.chdir(r"../../output/NOAA-data-csv-sorted")
-
-        CRO_id = (df['filename']).values.tolist()
-
-        for file in CRO_id:
-            os.mkdir(file[:-5])
-            os.chdir(file[:-5])
+        dictionary = self.CRO_NOAA_dictionary()
 
-            NOAA_list = dict[file[:-5]]
+        self.index_station_files(self.json_path)
 
-            for NOAA_station in NOAA_list:
+        # every station is converted once on the pool, the views are then
+        # built in the order of the report
+        NOAA_stations = list(dict.fromkeys(x for stations in dictionary.values()
+                                           for x in stations))
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            list(executor.map(self.station_table, NOAA_stations))
 
-                os.chdir(r"../../../output/NOAA-data-JSON")
-                path = r"../../output/NOAA-data-JSON"
+            writes = []
+            for CRO_id, NOAA_stations in dictionary.items():
+                station_tables = {x: self.station_tables[x] for x in NOAA_stations
+                                  if x in self.station_tables}
 
-                for json_file in os.listdir(path):
-                    file_name = json_file[:-5]
-                    if file_name in NOAA_station:
-                        f = open(json_file, )
-                        data = json.load(f)
+                self.views[CRO_id] = list(station_tables)
+                if self.write:
+                    writes.append(executor.submit(self.write_view, CRO_id, station_tables))
 
-                        df = self.convert_to_csv(data)
+            for write in writes:
+                write.result()
 
-                        os.chdir(r"../../output/NOAA-data-csv-sorted/" + file[:-5])
-                        df.to_csv(file_name + ".csv")
+        return self.station_tables
 
-                        os.chdir(r"../../../output/NOAA-data-csv/")
-                        df.to_csv(file_name + ".csv")
+    # write the tables and views kept in memory
+    def write_outputs(self):
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            writes = [executor.submit(self.store.write, NOAA_station, df)
+                      for NOAA_station, df in self.station_tables.items()]
 
-                os.chdir(r"../../output/NOAA-data-csv-sorted/" + file[:-5])
+            writes += [executor.submit(self.write_view, CRO_id,
+                                       {x: self.station_tables[x] for x in NOAA_stations})
+                       for CRO_id, NOAA_stations in self.views.items()]
 
-            os.chdir(r"../../../output/NOAA-data-csv-sorted")
-
-        os.chdir(r"../../")
+            for write in writes:
+                write.result()
 
 
 class DataCoverage:
 
-    def __init__(self, start_date, end_date):
+    def __init__(self, start_date, end_date, store=None, assignments=None, station_tables=None,
+                 output_root="output", workers=4):
         self.start = start_date
         self.end = end_date
+        self.output_root = output_root
+        self.workers = workers  # stations read and covered at the same time
+        self.store = store if store is not None else StationStore(output_root=output_root)
+        self.assignments = assignments  # read from disk when not given
+        self.station_tables = station_tables or {}  # tables in memory, others are read
 
-    def convert_to_dictionary(self):
-        os.chdir(r"output/NOAA-data-valid-station-report")
-        df = pd.read_csv("NOAA_valid_station_report.csv")
-
-        num_row = df.shape[0]
-        df = df.values.tolist()
+        # expected dates, shared by every station
+        self.date_original = self.generate_date_list(self.start, self.end)
+        self.date_index = pd.Index(self.date_original)
 
-        list_key = []
-        list_value = []
+        self.station_results = {}  # station id -> coverage of the station
 
-        for i in range(num_row):
-            temp_list = df[i]
-            new_list = [x for x in temp_list if pd.isnull(x) == False]
-
-            filename = new_list[1]
-            num_itr = new_list[2]  # number of iteration
-
-            sub_list = []
-            for j in range(1, num_itr + 1):
-                item = new_list[(j * 4 - 1): (j * 4) + 3]
-                sub_list.append(item)
-
-            list_key.append(filename)
-            list_value.append(sub_list)
-
-        dictionary = dict(zip(list_key, list_value))
-
-        os.chdir(r"../../")
+    # input file -> [station, distance, latitude, longitude] of its stations
+    def convert_to_dictionary(self):
+        assignments = self.assignments
+        if assignments is None:
+            assignments = StationAssignments.read(self.output_root)
 
-        return dictionary
+        return {filename: assignments.station_rows(filename)
+                for filename in assignments.points()}
 
     # take in a list and convert it datafranem then
-    def create_csv(self, list_whole):
-        df = pd.DataFrame(list_whole, columns=["filename", "station_ID", "distance",
-                                               "latitude", "longitude", "date_cov",
-                                               "tmin_cov", "tmax_cov", "prcp_cov"])
-
-        os.chdir(r"output/NOAA-data-coverage")
+    def coverage_table(self, list_whole):
+        return pd.DataFrame(list_whole, columns=["filename", "station_ID", "distance",
+                                                 "latitude", "longitude", "date_cov",
+                                                 "tmin_cov", "tmax_cov", "prcp_cov"])
 
-        df.to_csv("NOAA_data_coverage.csv")
+    def create_csv(self, list_whole):
+        df = self.coverage_table(list_whole)
 
-        os.chdir(r"../../")
+        df.to_csv(os.path.join(self.output_root, "NOAA-data-coverage", "NOAA_data_coverage.csv"))
 
     def generate_date_list(self, start_date, end_date):
-        df = pd.date_range(start=start_date, end=end_date)
-
-        list_date = []
-
-        for i in range(df.shape[0]):
-            date = str(df[i])[:10]
-            list_date.append(date)
-
-        return list_date
-
-    # function that returns the missing date of NOAA data
-    def missing_date_value(self, date_original, list_date):
-        date_original = set(date_original)
-        list_date = set(list_date)
-
-        missing = list(sorted(date_original - list_date))
-
-        return len(missing), missing
-
-    def tmin_missing_date(self, station_id):
-        os.chdir(r"output/NOAA-data-csv")
-        df = pd.read_csv(station_id + ".csv")
-        df_date = df['date'].tolist()
-        df_tmin = df['min'].tolist()
-
-        tmin_missing_list = []
-
-        for index, value in enumerate(df_tmin):
-            if math.isnan(value):
-                tmin_missing_list.append(df_date[index])
-
-        os.chdir(r"../../")
+        return pd.date_range(start=start_date, end=end_date).strftime("%Y-%m-%d").tolist()
+
+    # first and last position of every run of True in a boolean array
+    def gap_intervals(self, missing):
+        edges = np.diff(np.concatenate(([0], missing.astype(np.int8), [0])))
+
+        return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+    # [variable, start, end, length] of every run of missing days of the
+    # station. "date" are the days without any record, the other variables
+    # are missing on the days without a value
+    def station_gaps(self, df):
+        positions = self.date_index.get_indexer(df['date'])
+        inside = positions >= 0
+
+        variables = {"date": inside}
+        for column in df.columns:
+            if column != "date" and not column.startswith("Unnamed"):
+                variables[column] = inside & df[column].notna().to_numpy()
+
+        gaps = []
+        for variable, present in variables.items():
+            missing = np.ones(len(self.date_index), dtype=bool)
+            missing[positions[present]] = False
+
+            starts, ends = self.gap_intervals(missing)
+            gaps.extend(zip([variable] * len(starts), self.date_index[starts],
+                            self.date_index[ends], (ends - starts + 1).tolist()))
+
+        return gaps
+
+    # read the station csv once and compute all of its coverage numbers together.
+    # None for a station without a table, its download failed
+    def station_coverage(self, station_id):
+        if station_id in self.station_results:
+            return self.station_results[station_id]
+
+        df = self.station_tables.get(station_id)
+        if df is None:
+            try:
+                df = self.store.read(station_id)
+            except FileNotFoundError:
+                logging.warning("No data for station %s, left out of the coverage", station_id)
+                self.station_results[station_id] = None
+                return None
+
+        original_date_len = len(self.date_original)
+        missing_date_num = int((~self.date_index.isin(df['date'])).sum())
+
+        result = {
+            "date_cov": (original_date_len - missing_date_num) / original_date_len * 100,
+            "tmin_cov": df['min'].notna().sum() / original_date_len * 100,
+            "tmax_cov": df['max'].notna().sum() / original_date_len * 100,
+            "prcp_cov": df['precipitation'].notna().sum() / original_date_len * 100,
+            "gaps": self.station_gaps(df),
+        }
+
+        self.station_results[station_id] = result
+        metrics.count("stations_covered")
+
+        return result
+
+    # cover every station of the dictionary once, on the pool
+    def cover_stations(self, dictionary):
+        station_ids = list(dict.fromkeys(rows[0] for key in dictionary
+                                         for rows in dictionary[key]))
+        station_ids = [x for x in station_ids if x not in self.station_results]
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            list(executor.map(self.station_coverage, station_ids))
+
+    # one row per run of missing days of every variable, stations without
+    # gaps have no row
+    def missing_data_table(self, dictionary):
+        self.cover_stations(dictionary)
 
-        return tmin_missing_list
-
-    def create_missing_data_csv(self, dictionary):
         list_whole = []
         for key in dictionary:
             for j in range(len(dictionary[key])):
                 station_id = dictionary[key][j][0]
-                tmin_missing = self.tmin_missing_date(station_id)
-
-                list_sub = []
-                list_sub.append(key)
-                list_sub.append(station_id)
-                list_sub.append(tmin_missing)
-                list_whole.append(list_sub)
-
-        os.chdir(r"output/NOAA-data-missing-date")
-        df = pd.DataFrame(list_whole, columns=["filename", "station_id", "missing_date_tmin"])
-        df.to_csv("NOAA_data_missing_date.csv")
-
-        os.chdir(r"../../")
-
-    def date_coverage(self, station_id, date_original):
-        os.chdir(r"output/NOAA-data-csv")
-        df = pd.read_csv(station_id + ".csv")
-        df_date = df['date'].tolist()
-
-        original_date_len = len(date_original)
-        missing_date_num, missing_date_val = self.missing_date_value(date_original, df_date)
 
-        date_coverage_pct = (original_date_len - missing_date_num) / original_date_len * 100
+                coverage = self.station_coverage(station_id)
+                if coverage is None:
+                    continue
 
-        os.chdir(r"../../")
+                for gap in coverage["gaps"]:
+                    list_whole.append([key, station_id] + list(gap))
 
-        return date_coverage_pct
+        return pd.DataFrame(list_whole, columns=["filename", "station_id", "variable",
+                                                 "start", "end", "length"])
 
-    def min_max_prcp_coverage(self, station_id, date_original_len):
-        os.chdir(r"output/NOAA-data-csv")
-        df = pd.read_csv(station_id + ".csv")
-
-        min_nan_count = df['min'].isna().sum()
-        min_count = df.shape[0] - min_nan_count
-
-        max_nan_count = df['max'].isna().sum()
-        max_count = df.shape[0] - max_nan_count
-
-        prcp_nan_count = df['precipitation'].isna().sum()
-        prcp_count = df.shape[0] - prcp_nan_count
-
-        min_cov = min_count / date_original_len * 100
-        max_cov = max_count / date_original_len * 100
-        prcp_cov = prcp_count / date_original_len * 100
-
-        os.chdir(r"../../")
+    def create_missing_data_csv(self, dictionary):
+        df = self.missing_data_table(dictionary)
 
-        return min_cov, max_cov, prcp_cov
+        df.to_csv(os.path.join(self.output_root, "NOAA-data-missing-date",
+                               "NOAA_data_missing_date.csv"))
 
     def create_list_for_csv(self, dictionary):
-        date_original = self.generate_date_list(self.start, self.end)
+        self.cover_stations(dictionary)
 
         list_whole = []
         for key in dictionary:
             for j in range(len(dictionary[key])):
                 station_id = dictionary[key][j][0]
 
-                date_cov = self.date_coverage(station_id, date_original)
-                min_cov, max_cov, prcp_cov = self.min_max_prcp_coverage(station_id, len(date_original))
+                coverage = self.station_coverage(station_id)
+                if coverage is None:
+                    continue
 
                 list_each = dictionary[key][j]
                 list_each.insert(0, key)
-                list_each.append(date_cov)
-                list_each.append(min_cov)
-                list_each.append(max_cov)
-                list_each.append(prcp_cov)
+                list_each.append(coverage["date_cov"])
+                list_each.append(coverage["tmin_cov"])
+                list_each.append(coverage["tmax_cov"])
+                list_each.append(coverage["prcp_cov"])
 
                 list_whole.append(list_each)
 
         return list_whole
 
 
-def main():
+class ReportResults:
+
+    # tables of the report stages handed over in memory, written at the end
+    def __init__(self, report, assignments, converter, missing_dates, coverage,
+                 output_root="output"):
+        self.output_root = output_root
+        self.report = report  # wide valid station report
+        self.assignments = assignments
+        self.converter = converter  # JsonToCsv holding the station tables
+        self.missing_dates = missing_dates
+        self.coverage = coverage
+
+    @property
+    def station_tables(self):
+        return self.converter.station_tables
+
+    def write(self):
+        root = self.output_root
+        self.report.to_csv(os.path.join(root, "NOAA-data-valid-station-report",
+                                        "NOAA_valid_station_report.csv"))
+        self.assignments.write(root)
+        self.converter.write_outputs()
+        self.missing_dates.to_csv(os.path.join(root, "NOAA-data-missing-date",
+                                               "NOAA_data_missing_date.csv"))
+        self.coverage.to_csv(os.path.join(root, "NOAA-data-coverage", "NOAA_data_coverage.csv"))
+
+
+REPORT_STAGES = ("station_report", "json_to_csv", "data_coverage")
+
+
+# the report stages handing their tables to each other in memory, disk is
+# only written at the end when write is set. returns the ReportResults
+def generate_reports_in_memory(manifest, start_date, end_date, data_type, store,
+                               stream=False, json_path=None, write=True, output_root="output",
+                               workers=4):
+    with metrics.stage("station_report"):
+        s = StationReport(output_root, workers)
+        report, assignments = s.build_report()
+
+    with metrics.stage("json_to_csv"):
+        j = JsonToCsv(data_type.split(), store, stream, json_path, assignments, write=False,
+                      output_root=output_root, workers=workers)
+        station_tables = j.generate_report()
+
+    with metrics.stage("data_coverage"):
+        d = DataCoverage(start_date, end_date, store, assignments, station_tables, output_root,
+                         workers)
+        dic = d.convert_to_dictionary()
+        missing_dates = d.missing_data_table(dic)
+        coverage = d.coverage_table(d.create_list_for_csv(dic))
+
+    results = ReportResults(report, assignments, j, missing_dates, coverage, output_root)
+
+    # no stage is recorded before the outputs are on disk
+    if write:
+        with metrics.stage("write_outputs"):
+            results.write()
+        for stage in REPORT_STAGES:
+            if stage not in manifest.stages:
+                manifest.mark_stage(stage)
+
+    return results
+
+
+# stages working on the output folder under output_root, shared by the
+# single process run and every partition of a multi-process run. workers is
+# the number of threads converting and covering the stations
+def generate_reports(manifest, start_date, end_date, data_type, store, stream=False,
+                     json_path=None, in_memory=False, write=True, output_root="output",
+                     workers=4):
+    if in_memory and not all(stage in manifest.stages for stage in REPORT_STAGES):
+        return generate_reports_in_memory(manifest, start_date, end_date, data_type, store,
+                                          stream, json_path, write, output_root, workers)
+
+    # generate station report
+    if "station_report" not in manifest.stages:
+        with metrics.stage("station_report"):
+            s = StationReport(output_root, workers)
+            s.generate_report()
+        manifest.mark_stage("station_report")
+
+    # convert JSON to csv
+    if "json_to_csv" not in manifest.stages:
+        with metrics.stage("json_to_csv"):
+            j = JsonToCsv(data_type.split(), store, stream, json_path,
+                          output_root=output_root, workers=workers)
+            j.generate_report()
+        manifest.mark_stage("json_to_csv")
+
+    # data coverage and missing data report
+    if "data_coverage" not in manifest.stages:
+        with metrics.stage("data_coverage"):
+            d = DataCoverage(start_date, end_date, store, output_root=output_root,
+                             workers=workers)
+            dic = d.convert_to_dictionary()
+            d.create_missing_data_csv(dic)
+            list_csv = d.create_list_for_csv(dic)
+            d.create_csv(list_csv)
+        manifest.mark_stage("data_coverage")
+
+
+# search cache and inventory of a partition worker process, opened once
+_PARTITION_STATE = {}
+
+
+def setup_partition_worker(settings):
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s', level=settings["log_level"])
+    ncei_client.set_rate(settings["rate"])
+    search_api.SEARCH_URL = settings["search_url"]
+    search_api.DATA_URL = settings["data_url"]
+
+    _PARTITION_STATE["cache"] = SearchCache(settings["cache_path"])
+    _PARTITION_STATE["inventory"] = None
+    if settings["inventory_file"] is not None:
+        _PARTITION_STATE["inventory"] = StationInventory.load(settings["inventory_file"],
+                                                              settings["data_type"].split())
+
+
+# every partition folder holds the usual output layout of a run
+def open_partition(folder, settings):
+    m = MakeDirectory(folder)
+    m.make_directory()
+
+    return RunManifest(dict(settings["parameters"], partition=os.path.basename(folder)),
+                       os.path.join(folder, "run_manifest.jsonl"))
+
+
+# returns the input points using every station, the metrics and the number
+# of points searched for the first time
+def search_partition(folder, df, settings):
+    manifest = open_partition(folder, settings)
+    done = len(manifest.points)
+
+    c = StationSearch(df, settings["box_range"], settings["start_date"], settings["end_date"],
+                      settings["data_type"], cache=_PARTITION_STATE["cache"],
+                      inventory=_PARTITION_STATE["inventory"], nearest=settings["nearest"],
+                      manifest=manifest, output_root=folder)
+    station_points = c.search_points()
+
+    return (station_points, metrics.get_metrics().snapshot(reset=True),
+            len(manifest.points) - done)
+
+
+# refresh makes the reports again, the run downloaded stations the
+# partition may use
+def report_partition(folder, settings, refresh=False):
+    manifest = open_partition(folder, settings)
+    if refresh:
+        manifest.reopen_stages()
+
+    generate_reports(manifest, settings["start_date"], settings["end_date"],
+                     settings["data_type"], StationStore(settings["storage"], folder),
+                     settings["stream"], settings["json_path"], settings["in_memory"],
+                     output_root=folder, workers=settings["report_workers"])
+
+    return metrics.get_metrics().snapshot(reset=True)
+
+
+class PartitionedRun:
+
+    # the input points are read and searched a partition at a time on a pool
+    # of processes, every station is downloaded once by this process, then the
+    # reports of the partitions are made on the pool and merged in input order
+    def __init__(self, settings, processes, partition_size, manifest):
+        self.settings = settings
+        self.processes = processes
+        self.partition_size = partition_size
+        self.manifest = manifest
+        self.output_root = settings["output_root"]
+        self.root = os.path.join(self.output_root, "partitions")
+        self.folders = []  # partition folders in input order
+        self.point_order = {}  # input file -> position in the input
+
+    def partition_folder(self, number):
+        return os.path.join(self.root, "%05i" % number)
+
+    # a finished run is searched and downloaded again too, the points and
+    # stations that failed before are tried again and reopen the stages
+    def run(self, input_file):
+        station_points = {}
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                 initializer=setup_partition_worker,
+                                 initargs=(self.settings,)) as executor:
+            with metrics.stage("partition_search"):
+                futures = []
+                r = ReadCsvFile(input_file)
+                for number, df in enumerate(r.read_chunks(self.partition_size)):
+                    for station_id, latitude, longitude in df.values.tolist():
+                        filename = station_id + "_" + str(latitude) + "_" + str(longitude) + ".json"
+                        self.point_order.setdefault(filename, len(self.point_order))
+                    self.folders.append(self.partition_folder(number))
+                    futures.append(executor.submit(search_partition, self.folders[-1], df,
+                                                   self.settings))
+
+                # merged in partition order so the download order does not depend on timing
+                for future in futures:
+                    partition_points, snapshot, searched = future.result()
+                    metrics.get_metrics().merge(snapshot)
+                    if searched > 0:
+                        self.manifest.reopen_stages(("merge",))
+                    for NOAA_station, points in partition_points.items():
+                        station_points.setdefault(NOAA_station, []).extend(points)
+
+            c = StationSearch(None, self.settings["box_range"], self.settings["start_date"],
+                              self.settings["end_date"], self.settings["data_type"],
+                              self.settings["workers"], stream=self.settings["stream"],
+                              manifest=self.manifest, chunk_days=self.settings["chunk_days"],
+                              batch=self.settings["batch"], output_root=self.output_root,
+                              asynchronous=self.settings["asynchronous"],
+                              all_data_types=self.settings["all_data_types"])
+            fetched = c.download_stations(station_points, len(self.point_order))
+
+            with metrics.stage("partition_reports"):
+                futures = [executor.submit(report_partition, folder, self.settings,
+                                           len(fetched) > 0)
+                           for folder in self.folders]
+                for future in futures:
+                    metrics.get_metrics().merge(future.result())
+
+        if "merge" not in self.manifest.stages:
+            with metrics.stage("merge"):
+                self.merge()
+            self.manifest.mark_stage("merge")
+
+    # rows of a partition report in input order
+    def sorted_report(self, path, filename_column, index_col=0):
+        df = pd.read_csv(path, index_col=index_col, float_precision="round_trip")
+        order = df[filename_column].map(self.point_order)
+
+        return df.iloc[np.argsort(order.to_numpy(), kind="stable")]
+
+    def merge_report(self, folder, name, filename_column="filename", wide=False):
+        frames = []
+        for partition in self.folders:
+            path = os.path.join(partition, folder, name)
+            if os.path.exists(path):
+                frames.append(self.sorted_report(path, filename_column))
+        if not frames:
+            return
+
+        if wide:
+            # partitions hold different numbers of station columns, align them by position
+            for df in frames:
+                df.columns = range(df.shape[1])
+            df = pd.concat(frames, ignore_index=True)
+            df.columns = StationReport().report_columns((df.shape[1] - 2) // 4)
+        else:
+            df = pd.concat(frames, ignore_index=True)
+
+        df.to_csv(os.path.join(self.output_root, folder, name))
+
+    # the long tables follow the order of the merged wide report
+    def merge_assignments(self):
+        frames = []
+        for partition in self.folders:
+            path = os.path.join(partition, StationAssignments.FILE)
+            if os.path.exists(path):
+                frames.append(self.sorted_report(path, "filename", index_col=None))
+        if frames:
+            StationAssignments(pd.concat(frames, ignore_index=True)).write(self.output_root)
+
+    # move the per file outputs of the partitions next to the merged reports
+    def move_files(self, partition, folder):
+        source = os.path.join(partition, folder)
+        if not os.path.isdir(source):
+            return
+
+        target = os.path.join(self.output_root, folder)
+        os.makedirs(target, exist_ok=True)
+        for name in sorted(os.listdir(source)):
+            destination = os.path.join(target, name)
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+            os.replace(os.path.join(source, name), destination)
+
+    def merge(self):
+        self.merge_report("NOAA-data-valid-station-report", "NOAA_valid_station_report.csv",
+                          wide=True)
+        self.merge_assignments()
+        self.merge_report("NOAA-data-coverage", "NOAA_data_coverage.csv")
+        self.merge_report("NOAA-data-missing-date", "NOAA_data_missing_date.csv")
+
+        for partition in self.folders:
+            for folder in ["NOAA-data-station-info", "NOAA-data-csv", "NOAA-data-columnar",
+                           "NOAA-data-csv-sorted"]:
+                self.move_files(partition, folder)
+
+        shutil.rmtree(self.root)
+
+
+def main(
+        ##########################################
+        # input file and info
+        input_file=r"input_csv/input_example.csv",
+        box_range=100,
+        start_date="2020-01-01",
+        end_date="2021-08-11",
+        data_type="TMIN TMAX PRCP",
+        workers=8,  # number of stations downloaded at the same time
+        rate=5,  # maximum number of requests per second sent to NCEI
+        cache_path=r"cache/search_cache.sqlite",  # kept between runs
+        inventory_file=None,  # ghcnd-inventory.txt to search the stations offline
+        nearest=10,  # number of stations kept per input point with the inventory
+        storage="csv",  # "npz" keeps one binary columnar copy of every station
+        stream=False,  # write every response to disk as it arrives, chunks and batches too
+        chunk_days=1826,  # longer date ranges are downloaded as several requests at once
+        batch=True,  # download several stations per request
+        metrics_path="metrics.json",  # timings, requests and cache hits, under output_root
+        prometheus_path=None,  # also write the metrics in the Prometheus text format
+        profile_dir=None,  # cProfile every stage into this folder, or into NOAA_PROFILE_DIR
+        processes=1,  # more than 1 searches and reports partitions of the input on processes
+        partition_size=1000,  # input points per partition with processes
+        in_memory=False,  # hand the tables between the report stages without disk
+        write_outputs=True,  # False with in_memory only returns the tables
+        output_root=r"output",  # every output is written under this folder
+        report_workers=4,  # threads converting and covering the stations
+        asynchronous=False,  # download on one asyncio event loop, needs aiohttp
+        all_data_types=False,  # download every data type, attribute and the station location
+        ##########################################
+):
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    # absolute paths only, the current directory is never changed so a
+    # long-running process can call main for several runs
+    output_root = os.path.abspath(output_root)
+    metrics.get_metrics().reset()
+
     # make folder to store output
-    m = MakeDirectory()
+    m = MakeDirectory(output_root)
     m.make_directory()
 
-    ##########################################
-    # input file and info
-    input_file = r"input_csv/input_example.csv"
-    box_range = 100
-    start_date = "2020-01-01"
-    end_date = "2021-08-11"
-    data_type = "TMIN TMAX PRCP"
-    ##########################################
+    # finished work of an interrupted run with the same parameters is skipped
+    parameters = {"input_file": input_file, "box_range": box_range,
+                  "start_date": start_date, "end_date": end_date,
+                  "data_type": data_type, "inventory_file": inventory_file,
+                  "nearest": nearest, "storage": storage}
+    if processes > 1:
+        parameters["partition_size"] = partition_size
+    if all_data_types:
+        parameters["all_data_types"] = True
+    manifest = RunManifest(parameters, os.path.join(output_root, "run_manifest.jsonl"))
+
+    # the limiter is kept between runs with the same rate, it remembers the
+    # slow downs asked by NCEI
+    if ncei_client.get_limiter().max_rate != rate:
+        ncei_client.set_rate(rate)
+    # NOAA_PROFILE_DIR when profile_dir is None. without either the profiling
+    # left on by an earlier run in this process is switched off
+    metrics.set_profiling(metrics.default_profile_dir(profile_dir))
+    if metrics_path is not None:
+        metrics_path = os.path.join(output_root, metrics_path)
+    if prometheus_path is not None:
+        prometheus_path = os.path.join(output_root, prometheus_path)
+
+    if processes > 1:
+        # the processes share the request rate
+        settings = {"parameters": parameters, "box_range": box_range,
+                    "start_date": start_date, "end_date": end_date, "data_type": data_type,
+                    "workers": workers, "rate": rate / processes,
+                    "cache_path": os.path.abspath(cache_path),
+                    "inventory_file": (os.path.abspath(inventory_file)
+                                       if inventory_file is not None else None),
+                    "nearest": nearest, "storage": storage, "stream": stream,
+                    "chunk_days": chunk_days, "batch": batch,
+                    "json_path": os.path.join(output_root, "NOAA-data-JSON"),
+                    "output_root": output_root, "report_workers": report_workers,
+                    "asynchronous": asynchronous, "all_data_types": all_data_types,
+                    "search_url": search_api.SEARCH_URL, "data_url": search_api.DATA_URL,
+                    "log_level": logging.getLogger().getEffectiveLevel(),
+                    "in_memory": in_memory}
+        p = PartitionedRun(settings, processes, partition_size, manifest)
+        p.run(input_file)
+
+        if metrics_path is not None:
+            metrics.get_metrics().write(metrics_path, prometheus_path)
+        return
 
     # read input csv file
     r = ReadCsvFile(input_file)
     df = r.read_csv()
 
-    # generate command and run the command
-    c = CommandLine(df, box_range, start_date, end_date, data_type)
-    c.operate_command()
+    inventory = None
+    if inventory_file is not None:
+        inventory = StationInventory.load(inventory_file, data_type.split())
 
-    # generate station report
-    s = StationReport()
-    s.generate_report()
+    # search the stations of every input point and download their data
+    c = StationSearch(df, box_range, start_date, end_date, data_type, workers,
+                      SearchCache(cache_path), inventory, nearest, stream, manifest,
+                      chunk_days, batch, output_root, asynchronous, all_data_types)
+    c.operate_search()
 
-    # convert JSON to csv
-    j = JsonToCsv()
-    j.generate_report()
+    # station report, csv conversion and data coverage
+    results = generate_reports(manifest, start_date, end_date, data_type,
+                               StationStore(storage, output_root), stream, in_memory=in_memory,
+                               write=write_outputs, output_root=output_root,
+                               workers=report_workers)
 
-    # data coverage and missing data report
-    d = DataCoverage(start_date, end_date)
-    dic = d.convert_to_dictionary()
-    d.create_missing_data_csv(dic)
-    list_csv = d.create_list_for_csv(dic)
-    d.create_csv(list_csv)
+    if metrics_path is not None:
+        metrics.get_metrics().write(metrics_path, prometheus_path)
+
+    return results
 
 
 if __name__ == "__main__":
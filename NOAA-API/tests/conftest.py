@@ -0,0 +1,35 @@
+import os
+import sys
+
+NOAA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for folder in [NOAA_DIR,
+               os.path.join(NOAA_DIR, "ncei-weather-api-evaluation", "scripts"),
+               os.path.join(NOAA_DIR, "benchmarks")]:
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+
+import pytest  # noqa: E402
+
+import fake_ncei  # noqa: E402
+import ncei_client  # noqa: E402
+import search_api  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_server():
+    """fake_ncei server shared by the tests"""
+    server = fake_ncei.start_server(2000)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def fake_api(fake_server, monkeypatch):
+    """point search_api at the fake server, without rate limit"""
+    monkeypatch.setattr(search_api, "SEARCH_URL", fake_server.base_url + fake_ncei.SEARCH_PATH)
+    monkeypatch.setattr(search_api, "DATA_URL", fake_server.base_url + fake_ncei.DATA_PATH)
+    rate = ncei_client.get_limiter().max_rate
+    ncei_client.set_rate(10000)
+    yield fake_server
+    ncei_client.set_rate(rate)
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from json_stream import iter_json_array, write_json_array, iter_json_file
+
+RECORDS = [{"DATE": "2020-01-01", "STATION": "USC00000001", "PRCP": "1.5", "NAME": "Zürich"},
+           {"DATE": "2020-01-02", "STATION": "USC00000001", "PRCP": "", "NAME": "Zürich"}]
+
+
+def test_records_split_at_every_byte():
+    data = json.dumps(RECORDS, indent=2).encode("utf-8")
+    for split in range(len(data) + 1):
+        assert list(iter_json_array([data[:split], data[split:]])) == RECORDS
+
+
+def test_numbers_split_at_every_byte():
+    data = b"[123, 4.5e6, -7]"
+    for split in range(len(data) + 1):
+        assert list(iter_json_array([data[:split], data[split:]])) == [123, 4.5e6, -7]
+
+
+def test_one_byte_chunks():
+    data = json.dumps(RECORDS).encode("utf-8")
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert list(iter_json_array(chunks)) == RECORDS
+
+
+def test_empty_array():
+    assert list(iter_json_array([b"[", b" ]"])) == []
+
+
+def test_error_object():
+    error = {"errorMessage": "invalid parameter", "errorCode": 400}
+    with pytest.raises(ValueError) as raised:
+        list(iter_json_array([json.dumps(error).encode("utf-8")]))
+    assert raised.value.args == ("response is not a JSON array", error)
+
+
+def test_unterminated_array():
+    data = json.dumps(RECORDS).encode("utf-8")[:-1]
+    records = iter_json_array([data])
+    assert next(records) == RECORDS[0]
+    assert next(records) == RECORDS[1]
+    with pytest.raises(ValueError, match="not terminated"):
+        next(records)
+
+
+def test_truncated_record():
+    data = json.dumps(RECORDS).encode("utf-8")[:-20]
+    with pytest.raises(ValueError):
+        list(iter_json_array([data]))
+
+
+def test_empty_response():
+    with pytest.raises(ValueError, match="empty"):
+        list(iter_json_array([b"", b"  "]))
+
+
+def test_write_and_read_file(tmp_path):
+    path = str(tmp_path / "station.json")
+    assert write_json_array(iter(RECORDS), path, chunk_records=1) == 2
+    assert list(iter_json_file(path, chunk_bytes=7)) == RECORDS
+    with open(path) as fin:
+        assert json.load(fin) == RECORDS
@@ -0,0 +1,22 @@
+import metrics
+
+
+def test_profile_dir_falls_back_to_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv("NOAA_PROFILE_DIR", str(tmp_path))
+    assert metrics.default_profile_dir() == str(tmp_path)
+    assert metrics.default_profile_dir("profiles") == "profiles"
+
+    monkeypatch.delenv("NOAA_PROFILE_DIR")
+    assert metrics.default_profile_dir() is None
+
+
+def test_profiling_writes_one_file_per_stage(tmp_path):
+    registry = metrics.Metrics()
+    registry.set_profiling(str(tmp_path))
+    with registry.stage("search"):
+        sum(range(1000))
+    registry.set_profiling(None)
+    with registry.stage("download"):
+        sum(range(1000))
+
+    assert [path.name.split(".")[0] for path in tmp_path.iterdir()] == ["search"]
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import ncei_client
+import search_api
+
+from test_search_api import ATTRIBUTES, read_station_files
+
+pytest.importorskip("aiohttp")
+
+import ncei_async  # noqa: E402
+
+
+def test_client_shares_the_limiter():
+    assert ncei_async.AsyncClient().limiter is ncei_client.get_limiter()
+    assert ncei_async.AsyncClient(rate=5).limiter is not ncei_client.get_limiter()
+
+
+def test_search_matches_threaded_search(fake_api):
+    points = [(41.0, -95.0), (41.5, -94.5)]
+
+    async def search():
+        async with ncei_async.AsyncClient() as client:
+            return await client.search_points(points, "2020-01-01", "2020-12-31", ATTRIBUTES)
+
+    results = asyncio.run(search())
+    assert results == [search_api.search_stations(*point, "2020-01-01", "2020-12-31",
+                                                  ATTRIBUTES)
+                       for point in points]
+
+
+def test_download_matches_threaded_download(fake_api, tmp_path):
+    station_ids = ["USC%08d" % number for number in range(6)]
+    threaded_path = str(tmp_path / "threaded")
+    async_path = str(tmp_path / "async")
+
+    threaded = search_api.fetch_stations_data(station_ids, "daily-summaries", "2019-11-01",
+                                              "2020-02-29", threaded_path,
+                                              data_types=ATTRIBUTES)
+    fetched = ncei_async.fetch_stations_data(station_ids, "daily-summaries", "2019-11-01",
+                                             "2020-02-29", async_path, chunk_days=30,
+                                             batch=True, data_types=ATTRIBUTES)
+
+    assert sorted(threaded) == sorted(fetched) == station_ids
+    assert read_station_files(async_path) == read_station_files(threaded_path)
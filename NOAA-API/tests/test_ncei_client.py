@@ -0,0 +1,119 @@
+import email.utils
+import time
+
+import pytest
+
+import ncei_client
+
+
+def pool_size(session):
+    return session.get_adapter("https://www.ncei.noaa.gov")._pool_maxsize
+
+
+def test_session_pool_grows_with_workers(monkeypatch):
+    monkeypatch.setattr(ncei_client, "_SESSION", None)
+    monkeypatch.setattr(ncei_client, "_SESSION_POOL_SIZE", 0)
+
+    session = ncei_client.get_session()
+    assert pool_size(session) == ncei_client.POOL_SIZE
+    assert ncei_client.get_session(8) is session
+
+    larger = ncei_client.get_session(ncei_client.POOL_SIZE * 2)
+    assert pool_size(larger) == ncei_client.POOL_SIZE * 2
+    # fewer workers keep the larger pool
+    assert ncei_client.get_session() is larger
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b"{}"
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, **options):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ncei_client.time, "sleep", sleeps.append)
+    monkeypatch.setattr(ncei_client, "_LIMITER", ncei_client.RateLimiter(1000))
+    return sleeps
+
+
+def test_limiter_spaces_requests_after_the_burst():
+    limiter = ncei_client.RateLimiter(10, burst=2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_limiter_slows_down_and_climbs_back():
+    limiter = ncei_client.RateLimiter(8, min_rate=1)
+    for _ in range(5):
+        limiter.slow_down()
+    assert limiter.rate == 1
+
+    limiter.slow_down(retry_after=30)
+    assert limiter.reserve() == pytest.approx(30, abs=0.5)
+
+    for _ in range(100):
+        limiter.speed_up()
+    assert limiter.rate == 8
+
+
+@pytest.mark.parametrize("value, seconds", [("12", 12.0), ("-3", 0.0), ("soon", None)])
+def test_retry_after_seconds(value, seconds):
+    assert ncei_client.retry_after_seconds(FakeResponse(503, {"Retry-After": value})) == seconds
+
+
+def test_retry_after_date():
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    seconds = ncei_client.retry_after_seconds(FakeResponse(429, {"Retry-After": date}))
+    assert 55 < seconds <= 60
+    assert ncei_client.retry_after_seconds(FakeResponse(429)) is None
+
+
+def test_get_retries_and_waits_for_retry_after(sleeps):
+    first = FakeResponse(503, {"Retry-After": "120"})
+    session = FakeSession([first, FakeResponse(200)])
+
+    response = ncei_client.get("https://example.test/access/services/data/v1", {}, session)
+
+    assert response.status_code == 200 and session.calls == 2
+    assert first.closed
+    # the wait asked by the server is longer than the backoff
+    assert sleeps[0] == 120
+    # halved by the 503, one step back up after the 200
+    assert ncei_client.get_limiter().rate == 550
+
+
+def test_get_returns_the_last_answer_after_the_retries(sleeps):
+    session = FakeSession([FakeResponse(500) for _ in range(3)])
+
+    response = ncei_client.get("https://example.test/access/services/data/v1", {}, session,
+                               retries=2)
+
+    assert response.status_code == 500 and session.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_get_does_not_retry_client_errors(sleeps):
+    session = FakeSession([FakeResponse(404)])
+
+    response = ncei_client.get("https://example.test/access/services/data/v1", {}, session)
+
+    assert response.status_code == 404 and session.calls == 1
+    assert sleeps == []
@@ -0,0 +1,177 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import read_csv_file
+import search_api
+
+
+def coverage(tmp_path, station_tables=None):
+    store = read_csv_file.StationStore(output_root=str(tmp_path))
+    return read_csv_file.DataCoverage("2020-01-01", "2020-01-07", store,
+                                      station_tables=station_tables, output_root=str(tmp_path))
+
+
+def test_gap_intervals(tmp_path):
+    missing = np.array([True, True, False, True, False, False, True])
+    starts, ends = coverage(tmp_path).gap_intervals(missing)
+    assert starts.tolist() == [0, 3, 6]
+    assert ends.tolist() == [1, 3, 6]
+
+
+def test_gap_intervals_without_gaps(tmp_path):
+    starts, ends = coverage(tmp_path).gap_intervals(np.zeros(5, dtype=bool))
+    assert len(starts) == len(ends) == 0
+
+
+def test_station_coverage(tmp_path):
+    df = pd.DataFrame({"date": ["2020-01-01", "2020-01-02", "2020-01-05", "2020-01-06"],
+                       "min": [1.0, 2.0, np.nan, 3.0],
+                       "max": [5.0, 6.0, 7.0, 8.0],
+                       "precipitation": [0.0, np.nan, np.nan, 1.0]})
+    result = coverage(tmp_path, {"A": df}).station_coverage("A")
+    assert result["date_cov"] == 4 / 7 * 100
+    assert result["tmin_cov"] == 3 / 7 * 100
+    assert ("date", "2020-01-03", "2020-01-04", 2) in result["gaps"]
+    assert ("date", "2020-01-07", "2020-01-07", 1) in result["gaps"]
+    assert ("min", "2020-01-03", "2020-01-05", 3) in result["gaps"]
+
+
+def test_station_without_table(tmp_path):
+    assert coverage(tmp_path).station_coverage("missing") is None
+
+
+def test_manifest_reopens_stages(tmp_path):
+    path = str(tmp_path / "run_manifest.jsonl")
+    manifest = read_csv_file.RunManifest({"run": 1}, path)
+    manifest.mark_point("a.json", ["A"])
+    manifest.mark_station("A")
+    for stage in read_csv_file.REPORT_STAGES:
+        manifest.mark_stage(stage)
+
+    manifest.mark_station("B")
+    assert manifest.stages == set()
+    # the reopened stages stay open after a restart
+    assert read_csv_file.RunManifest({"run": 1}, path).stages == set()
+
+
+def run_pipeline(tmp_path, output_root="output", **options):
+    points = tmp_path / "points.csv"
+    if not points.exists():
+        points.write_text("station_name,Latitude,Longitude\n"
+                          "station_1,43.08037,-98.07269\n"
+                          "station_2,41.22,-97.5\n")
+    read_csv_file.main(input_file=str(points), start_date="2020-01-01", end_date="2020-06-30",
+                       rate=10000, cache_path=str(tmp_path / "search_cache.sqlite"),
+                       metrics_path=None, output_root=str(tmp_path / output_root), **options)
+    return tmp_path / output_root
+
+
+def coverage_stations(output):
+    df = pd.read_csv(output / "NOAA-data-coverage" / "NOAA_data_coverage.csv")
+    return set(df["station_ID"])
+
+
+def output_files(output):
+    """relative path -> text of every output, the run manifest left out"""
+    return {str(path.relative_to(output)): path.read_text()
+            for path in output.rglob("*")
+            if path.is_file() and path.name != "run_manifest.jsonl"}
+
+
+def test_resume_reports_station_downloaded_later(fake_api, tmp_path, monkeypatch):
+    station = sorted(coverage_stations(run_pipeline(tmp_path, "complete")))[0]
+    fetch_station_data = search_api.fetch_station_data
+
+    def unavailable(station_id, *args, **kwargs):
+        if station in station_id.split(","):
+            raise ValueError("data API returned an error (status 503)")
+        return fetch_station_data(station_id, *args, **kwargs)
+
+    # the download of the station fails in the first run
+    monkeypatch.setattr(search_api, "fetch_station_data", unavailable)
+    output = run_pipeline(tmp_path, batch=False)
+    assert station not in coverage_stations(output)
+    assert not (output / "NOAA-data-csv" / (station + ".csv")).exists()
+
+    monkeypatch.setattr(search_api, "fetch_station_data", fetch_station_data)
+    run_pipeline(tmp_path, batch=False)
+    assert station in coverage_stations(output)
+    assert (output / "NOAA-data-csv" / (station + ".csv")).exists()
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_resume_after_lost_station(fake_api, tmp_path, processes):
+    output = run_pipeline(tmp_path, processes=processes, partition_size=1)
+    station = sorted(coverage_stations(output))[0]
+
+    # forget the station as if it had never been downloaded
+    manifest_path = output / "run_manifest.jsonl"
+    lost = json.dumps({"kind": "station", "station": station})
+    lines = manifest_path.read_text().splitlines()
+    manifest_path.write_text("".join(line + "\n" for line in lines if line != lost))
+    (output / "NOAA-data-JSON" / (station + ".json")).unlink()
+    (output / "NOAA-data-csv" / (station + ".csv")).unlink()
+
+    run_pipeline(tmp_path, processes=processes, partition_size=1)
+    assert (output / "NOAA-data-csv" / (station + ".csv")).exists()
+    assert station in coverage_stations(output)
+
+
+@pytest.mark.parametrize("error, recorded", [
+    (search_api.SearchError("Search exceeded maximum box length."), True),
+    (search_api.SearchAPIError("Service Unavailable"), False)])
+def test_search_point_records_only_finished_searches(tmp_path, monkeypatch, error, recorded):
+    def search_stations(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(search_api, "search_stations", search_stations)
+    manifest = read_csv_file.RunManifest({"run": 1}, str(tmp_path / "run_manifest.jsonl"))
+    c = read_csv_file.StationSearch(None, 100, "2020-01-01", "2020-12-31", "TMIN TMAX PRCP",
+                                    manifest=manifest, output_root=str(tmp_path))
+
+    assert c.search_point("station_1", 43.0, -98.0) == []
+    assert ("station_1_43.0_-98.0.json" in manifest.points) is recorded
+
+
+def test_npz_store_round_trip(tmp_path):
+    store = read_csv_file.StationStore("npz", str(tmp_path))
+    df = pd.DataFrame({"date": ["2020-01-01", "2020-01-02", "2020-01-04"],
+                       "min": [-1.5, np.nan, 2.0],
+                       "max": [4.0, 5.5, np.nan],
+                       "precipitation": [0.0, 1.25, np.nan]})
+    store.write("A", df)
+
+    pd.testing.assert_frame_equal(store.read("A"), df)
+
+
+def test_partitions_merge_to_the_single_process_outputs(fake_api, tmp_path):
+    single = output_files(run_pipeline(tmp_path, "single"))
+    partitioned = output_files(run_pipeline(tmp_path, "partitioned", processes=2,
+                                            partition_size=1))
+    assert "NOAA-data-coverage/NOAA_data_coverage.csv" in single
+    assert partitioned == single
+
+
+def test_in_memory_reports_match_disk_reports(fake_api, tmp_path):
+    on_disk = output_files(run_pipeline(tmp_path, "disk"))
+    assert output_files(run_pipeline(tmp_path, "memory", in_memory=True)) == on_disk
+
+
+def test_in_memory_reports_without_outputs(fake_api, tmp_path):
+    on_disk = output_files(run_pipeline(tmp_path, "disk"))
+    output = tmp_path / "tables"
+    results = read_csv_file.main(
+        input_file=str(tmp_path / "points.csv"),
+        start_date="2020-01-01", end_date="2020-06-30", rate=10000,
+        cache_path=str(tmp_path / "search_cache.sqlite"), metrics_path=None,
+        output_root=str(output), in_memory=True, write_outputs=False)
+
+    assert not (output / "NOAA-data-coverage" / "NOAA_data_coverage.csv").exists()
+    assert results.coverage.to_csv() == \
+        on_disk["NOAA-data-coverage/NOAA_data_coverage.csv"]
+    assert results.missing_dates.to_csv() == \
+        on_disk["NOAA-data-missing-date/NOAA_data_missing_date.csv"]
+    assert set(results.station_tables) == coverage_stations(tmp_path / "disk")
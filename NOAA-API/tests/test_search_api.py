@@ -0,0 +1,180 @@
+import datetime
+import json
+import math
+import os
+
+import pytest
+
+import search_api
+
+ATTRIBUTES = ["TMIN", "TMAX", "PRCP"]
+
+
+def test_split_date_range():
+    chunks = search_api.split_date_range("2020-01-01", "2020-03-01", 30)
+    assert chunks == [("2020-01-01", "2020-01-30"), ("2020-01-31", "2020-02-29"),
+                      ("2020-03-01", "2020-03-01")]
+
+
+def test_split_date_range_is_contiguous():
+    chunks = search_api.split_date_range("1999-12-31", "2024-02-29", 365)
+    assert chunks[0][0] == "1999-12-31" and chunks[-1][1] == "2024-02-29"
+    for (_, end), (start, _) in zip(chunks, chunks[1:]):
+        assert (datetime.date.fromisoformat(start) -
+                datetime.date.fromisoformat(end)).days == 1
+    for start, end in chunks:
+        assert (datetime.date.fromisoformat(end) -
+                datetime.date.fromisoformat(start)).days < 365
+
+
+def test_split_date_range_one_chunk():
+    assert search_api.split_date_range("2020-01-01", "2020-01-05", 1826) == \
+        [("2020-01-01", "2020-01-05")]
+
+
+def test_merge_records():
+    first = [{"STATION": "A", "DATE": "2020-01-02"}, {"STATION": "A", "DATE": "2020-01-01"}]
+    second = [{"STATION": "A", "DATE": "2020-01-02"}, {"STATION": "A", "DATE": "2020-01-03"}]
+    merged = search_api.merge_records([first, second])
+    assert [record["DATE"] for record in merged] == ["2020-01-01", "2020-01-02", "2020-01-03"]
+
+
+def test_merge_one_chunk():
+    records = [{"STATION": "A", "DATE": "2020-01-02"}]
+    assert search_api.merge_records([records]) is records
+
+
+def test_station_batches():
+    station_ids = ["S%02i" % number for number in range(30)]
+    batches = search_api.station_batches(station_ids, 365)
+    # 30 stations in two batches of 15 instead of 25 and 5
+    assert [len(batch) for batch in batches] == [15, 15]
+    assert sum(batches, []) == station_ids
+
+
+def test_station_batches_limit_days():
+    station_ids = ["S%02i" % number for number in range(10)]
+    batches = search_api.station_batches(station_ids, 10 * 366)
+    for batch in batches:
+        assert len(batch) * 10 * 366 <= search_api.MAX_STATION_DAYS
+    assert sum(batches, []) == station_ids
+    assert search_api.station_batches(station_ids, 100 * 366) == [[x] for x in station_ids]
+    assert search_api.station_batches([], 365) == []
+
+
+def test_split_by_station():
+    data = [{"STATION": "A", "DATE": "1"}, {"STATION": "B", "DATE": "1"},
+            {"STATION": "C", "DATE": "1"}]
+    assert search_api.split_by_station(data, ["A", "B"]) == {"A": [data[0]], "B": [data[1]]}
+
+
+@pytest.mark.parametrize("point", [(41.0, -98.0), (42.2, -96.5), (43.4, -94.0), (44.6, -91.5)])
+def test_single_box_matches_doubling(fake_api, monkeypatch, point):
+    # small pages so the search has to follow the offset
+    monkeypatch.setattr(search_api, "SEARCH_PAGE", 7)
+    single = search_api.search_stations(*point, "2020-01-01", "2020-12-31", ATTRIBUTES)
+    doubling = search_api.search_stations(*point, "2020-01-01", "2020-12-31", ATTRIBUTES,
+                                          doubling=True)
+    assert single["stations"] == doubling["stations"]
+
+
+def test_snap_bounds_contains_bounds():
+    bounds = search_api.bbox_bounds(41.37, -97.12, search_api.largest_length(100))
+    snapped = search_api.snap_bounds(bounds)
+    north, west, south, east = bounds
+    snapped_north, snapped_west, snapped_south, snapped_east = snapped
+    assert snapped_north >= north and snapped_south <= south
+    assert snapped_west <= west and snapped_east >= east
+    # nearby points request the same box
+    near = search_api.bbox_bounds(41.38, -97.11, search_api.largest_length(100))
+    assert search_api.snap_bounds(near) == snapped
+
+
+def read_station_files(data_path):
+    files = {}
+    for name in os.listdir(data_path):
+        with open(os.path.join(data_path, name)) as fin:
+            files[name] = json.load(fin)
+    return files
+
+
+def test_streamed_batches_match_whole_download(fake_api, tmp_path):
+    station_ids = ["USC%08d" % number for number in range(6)]
+    whole_path = str(tmp_path / "whole")
+    streamed_path = str(tmp_path / "streamed")
+
+    whole = search_api.fetch_stations_data(station_ids, "daily-summaries", "2019-11-01",
+                                           "2020-02-29", whole_path, data_types=ATTRIBUTES)
+    streamed = search_api.fetch_stations_data(station_ids, "daily-summaries", "2019-11-01",
+                                              "2020-02-29", streamed_path, stream=True,
+                                              chunk_days=30, batch=True,
+                                              data_types=ATTRIBUTES)
+
+    assert sorted(whole) == sorted(streamed) == station_ids
+    whole_files = read_station_files(whole_path)
+    streamed_files = read_station_files(streamed_path)
+    assert any(whole_files.values())
+    # no part file is left behind
+    assert streamed_files == whole_files
+
+
+@pytest.mark.parametrize("chunk_days", [0, -5])
+def test_split_date_range_rejects_empty_chunks(chunk_days):
+    with pytest.raises(ValueError):
+        search_api.split_date_range("2020-01-01", "2020-01-05", chunk_days)
+
+
+def test_chunkdays_argument_is_positive():
+    arguments = ["-d", "daily-summaries", "-la", "40", "-lo", "-95", "-sd", "2020-01-01",
+                 "-ed", "2020-12-31", "-a", "PRCP"]
+    assert search_api.parse_arguments(arguments + ["-cd", "30"]).chunkdays == 30
+    with pytest.raises(SystemExit):
+        search_api.parse_arguments(arguments + ["-cd", "0"])
+
+
+def test_read_search_answer_errors():
+    error = {"errorCode": 503, "errorMessage": "Service Unavailable", "errors": []}
+    with pytest.raises(search_api.SearchAPIError):
+        search_api.read_search_answer(error, 503)
+    error = {"errorCode": 400, "errorMessage": "Bad request",
+             "errors": [{"message": "invalid bbox"}]}
+    with pytest.raises(search_api.SearchAPIError):
+        search_api.read_search_answer(error, 400)
+    with pytest.raises(search_api.SearchAPIError):
+        search_api.read_search_answer({"message": "Bad gateway"}, 502)
+    # an answer without results and without error has no station
+    assert search_api.read_search_answer({}, 200) == []
+
+
+def test_station_data_is_saved_compact(tmp_path):
+    records = [{"DATE": "2020-01-0%i" % day, "STATION": "A", "PRCP": "  12"} for day in (1, 2)]
+    search_api.save_station_data(records, "A", str(tmp_path))
+
+    with open(tmp_path / "A.json") as fin:
+        text = fin.read()
+    assert json.loads(text) == records
+    # one record per line, no indentation
+    assert text.splitlines()[1] == json.dumps(records[0]) + ","
+
+
+def test_chunked_download_completes_stations():
+    chunks = search_api.split_date_range("2020-01-01", "2020-01-20", 10)
+    download = search_api.ChunkedDownload(["A", "B"], chunks)
+    assert [(ids, position) for ids, position, _ in download.requests()] == \
+        [(["A"], 0), (["A"], 1), (["B"], 0), (["B"], 1)]
+
+    assert download.received(["A"], 1, {"A": [{"DATE": "2020-01-15"}]}) == []
+    assert download.received(["B"], 0, error=OSError("lost")) == []
+    assert download.received(["A"], 0, {"A": [{"DATE": "2020-01-05"}]}) == \
+        [("A", [[{"DATE": "2020-01-05"}], [{"DATE": "2020-01-15"}]])]
+    # a station with a failed chunk is completed without its chunks
+    assert download.received(["B"], 1, {"B": []}) == [("B", None)]
+
+
+def test_distance_calc():
+    stations = [{"latitude": "41.0", "longitude": "-95.0"},
+                {"latitude": "42.0", "longitude": "-95.0"}]
+    assert search_api.distance_calc(stations, 41.0, -95.0) is stations
+    assert stations[0]["distance"] == 0.0
+    assert stations[1]["distance"] == pytest.approx(search_api.RADIUS * math.pi / 180)
+    assert search_api.distance_calc([], 41.0, -95.0) == []
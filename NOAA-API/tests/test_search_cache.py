@@ -0,0 +1,66 @@
+import pytest
+
+import search_cache
+
+STATIONS = [{"id": "A", "latitude": 41.0, "longitude": -95.0},
+            {"id": "B", "latitude": 42.5, "longitude": -93.0}]
+BOUNDS = (43.0, -96.0, 40.0, -92.0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(search_cache.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    cache = search_cache.SearchCache(str(tmp_path / "cache" / "search.sqlite"), ttl=100)
+    yield cache
+    cache.close()
+
+
+def test_inner_bounds_are_filtered_from_the_cached_box(cache):
+    cache.put("daily-summaries", "2020-01-01", "2020-12-31", BOUNDS, STATIONS)
+
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31", BOUNDS) == STATIONS
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31",
+                     (42.0, -96.0, 40.0, -94.0)) == STATIONS[:1]
+
+
+def test_other_keys_and_larger_bounds_miss(cache):
+    cache.put("daily-summaries", "2020-01-01", "2020-12-31", BOUNDS, STATIONS)
+
+    assert cache.get("daily-summaries", "2020-01-01", "2020-06-30", BOUNDS) is None
+    assert cache.get("global-summary-of-the-month", "2020-01-01", "2020-12-31",
+                     BOUNDS) is None
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31",
+                     (44.0, -96.0, 40.0, -92.0)) is None
+
+
+def test_entries_expire_after_ttl(cache, clock):
+    cache.put("daily-summaries", "2020-01-01", "2020-12-31", BOUNDS, STATIONS)
+
+    clock[0] += 99
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31", BOUNDS) == STATIONS
+    clock[0] += 2
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31", BOUNDS) is None
+
+
+def test_least_recently_used_entries_are_evicted(cache, clock):
+    first = (41.0, -96.0, 40.0, -95.0)
+    second = (43.0, -94.0, 42.0, -92.0)
+    cache.put("daily-summaries", "2020-01-01", "2020-12-31", first, STATIONS[:1])
+    clock[0] += 1
+    cache.put("daily-summaries", "2020-01-01", "2020-12-31", second, STATIONS[1:])
+    clock[0] += 1
+    # the first entry was used last, the second one goes when the cache is full
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31", first) == STATIONS[:1]
+
+    cache.max_bytes = 2 * len('[{"id": "A", "latitude": 41.0, "longitude": -95.0}]')
+    clock[0] += 1
+    cache.put("daily-summaries", "2020-01-01", "2020-12-31", (31.0, -86.0, 30.0, -85.0), [])
+
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31", first) is not None
+    assert cache.get("daily-summaries", "2020-01-01", "2020-12-31", second) is None